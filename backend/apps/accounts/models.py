@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import uuid
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from django.conf import settings
 from django.db import models
 from django.urls import reverse
@@ -15,6 +15,18 @@ from apps.base.mail import ses_send_templated_mail
 import logging
 log = logging.getLogger(__name__)
 
+NOTIFICATION_BATCH_SIZE = 500
+
+
+def parse_due_date(due_date_str):
+    """Parse the `dd` preference value, None if missing or invalid"""
+    if due_date_str:
+        try:
+            return datetime.strptime(due_date_str, '%Y-%m-%d').date()
+        except Exception:
+            pass
+    return None
+
 
 class UserProxyManager(UserManager):
 
@@ -45,16 +57,102 @@ class UserProxyManager(UserManager):
             id__in=users_subscribed_false,
         ).distinct()
 
-    def generate_notifications(self, ref_date=None):
+    def generate_notifications(self, ref_date=None, weeks_before=1, user_ids=None):
         """
-        Generate notifications for all subscribers
+        Generate notifications for all subscribers in bulk.
+
+        Instead of looking up preferences, phase and notifications user by user,
+        this loads all subscriber due dates and the phase table once, works out
+        the due phase for everyone in memory, then issues one delete for
+        notifications generated under an old due date and one bulk insert.
+
+        Django 1.11 has no `ignore_conflicts` for `bulk_create`, so conflicts on
+        the user/phase/due_date unique key are avoided by skipping the rows we
+        already loaded. `send_notifications` holds a site lock while running,
+        so nothing else should insert in between.
+
+        :param user_ids: optionally restrict generation to these users
+        :returns: dict of user id -> (phase, due_date) for every subscriber
+                  with a notification due
         """
-        for u in self.subscribers():
+        from apps.timeline.models import Notification, PhaseMetadata, PregnancyHelper
+
+        subscribers = self.subscribers()
+        if user_ids is not None:
+            subscribers = subscribers.filter(id__in=user_ids)
+
+        # same precedence as UserProxy.get_preference: the first row wins
+        due_date_prefs = Preference.objects.filter(
+            key='dd',
+            user__in=subscribers,
+        ).order_by('id').values_list('user_id', 'user__email', 'val')
+
+        target_date = (ref_date or date.today()) + timedelta(weeks=weeks_before)
+        targets = {}
+        emails = {}
+        for user_id, email, due_date_str in due_date_prefs:
+            if user_id in targets:
+                continue
+            # one user's bad data shouldn't stop everyone else's notifications
             try:
-                u.generate_notifications(ref_date=ref_date)
+                due_date = parse_due_date(due_date_str)
+                if not due_date:
+                    continue
+                weekno = PregnancyHelper(due_date).get_weekno(ref_date=target_date)
+                phase = PhaseMetadata.objects.get_phase_by_weekno(weekno)
             except Exception as e:
-                log.error(str(e))
+                log.error('Failed to generate notification for user {}: {}'.format(user_id, e))
                 continue
+            if phase:
+                targets[user_id] = (phase, due_date)
+                emails[user_id] = email
+
+        if not targets:
+            return {}
+
+        # notifications generated for the target phase but another due date
+        # should be deleted, existing ones should be left alone
+        stale_ids = []
+        existing = set()
+        notifications = Notification.objects.filter(
+            user__in=subscribers,
+            phase_id__in={phase.id for phase, _ in targets.values()},
+        ).values_list('id', 'user_id', 'phase_id', 'due_date')
+        for notification_id, user_id, phase_id, due_date in notifications:
+            if user_id not in targets:
+                continue
+            phase, target_due_date = targets[user_id]
+            if phase_id != phase.id:
+                continue
+            if due_date == target_due_date:
+                existing.add(user_id)
+            else:
+                stale_ids.append(notification_id)
+
+        if stale_ids:
+            Notification.objects.filter(id__in=stale_ids).delete()
+
+        # phases without a subject have nothing to send
+        targets = {
+            user_id: (phase, due_date)
+            for user_id, (phase, due_date) in targets.items()
+            if phase.subject
+        }
+
+        Notification.objects.bulk_create(
+            [
+                Notification(
+                    user_id=user_id,
+                    phase=phase,
+                    due_date=due_date,
+                    email=emails[user_id],
+                )
+                for user_id, (phase, due_date) in targets.items()
+                if user_id not in existing
+            ],
+            batch_size=NOTIFICATION_BATCH_SIZE,
+        )
+        return targets
 
 
 class BroFormManager(models.Manager):
@@ -122,13 +220,7 @@ class UserProxy(User):
 
     @property
     def due_date(self):
-        due_date_str = self.get_preference('dd')
-        if due_date_str:
-            try:
-                return datetime.strptime(due_date_str, '%Y-%m-%d').date()
-            except Exception:
-                pass
-        return None
+        return parse_due_date(self.get_preference('dd'))
 
     def subscribe(self):
         return self.set_preference('subscribed', 'true')
@@ -149,41 +241,24 @@ class UserProxy(User):
         """
         Generate notificaiton for user.
 
-        This method will be trigged by a daily cron job.
+        Thin wrapper around the bulk UserProxyManager.generate_notifications,
+        which is what the cron job uses.
         """
         if not self.email:
             return
         if not self.subscribed:
             return
-        due_date = self.due_date
-        if not due_date:
-            return
 
-        helper = self.get_pregnancy_helper(due_date=due_date)
-        phase = helper.get_due_phase(
+        targets = UserProxy.objects.generate_notifications(
             ref_date=ref_date,
             weeks_before=weeks_before,
+            user_ids=[self.id],
         )
-        if not phase:
+        if self.id not in targets:
             return
 
-        # notifications generated for this phase but other due date should be deleted
-        self.notification_set.filter(
-            phase=phase
-        ).exclude(
-            due_date=due_date
-        ).delete()
-
-        if not phase.subject:
-            return
-
-        notification, created = self.notification_set.get_or_create(
-            phase=phase,
-            due_date=due_date,
-            defaults={
-                'email': self.email,
-            }
-        )
+        phase, due_date = targets[self.id]
+        notification = self.notification_set.get(phase=phase, due_date=due_date)
         if send:
             notification.send()
         return notification
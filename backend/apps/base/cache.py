@@ -0,0 +1,108 @@
+from collections import Counter, OrderedDict
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+
+# marks a key the backend doesn't have
+MISSING = object()
+
+
+class TieredCache:
+    """
+    An in-process LRU cache in front of another, slower, cache.
+
+    Reads are served from this process's memory while the entry is fresh,
+    and only go to the backend on a miss. Writes go to both. Entries are
+    kept under the backend's full, versioned key, so `version` works as it
+    does for the backend.
+
+    Values are shared between callers rather than copied, so they must be
+    treated as read only.
+
+    :param backend: the cache to put in front of, e.g. the default cache
+    :param max_entries: most entries held in memory, least recently used are dropped
+    :param timeout: seconds an entry is served from memory before the backend
+                    is read again, for values written by other processes. An
+                    entry written here is never held longer than the timeout
+                    it was written to the backend with.
+    """
+
+    def __init__(self, backend, max_entries=16, timeout=300):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.timeout = timeout
+        # full key -> (expiry time, value), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'memory': Counter(), 'backend': Counter()}
+
+    def get(self, key, default=None, version=None):
+        full_key = self.backend.make_key(key, version)
+        with self._lock:
+            entry = self._entries.get(full_key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(full_key)
+                self._stats['memory']['hits'] += 1
+                return entry[1]
+            self._entries.pop(full_key, None)
+            self._stats['memory']['misses'] += 1
+
+        value = self.backend.get(key, MISSING, version=version)
+        with self._lock:
+            if value is MISSING:
+                self._stats['backend']['misses'] += 1
+                return default
+            self._stats['backend']['hits'] += 1
+            self._remember(full_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        results = {}
+        for key in keys:
+            value = self.get(key, MISSING, version=version)
+            if value is not MISSING:
+                results[key] = value
+        return results
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.backend.set(key, value, timeout, version=version)
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.backend.default_timeout
+        with self._lock:
+            self._remember(self.backend.make_key(key, version), value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            self.set(key, value, timeout, version=version)
+        return []
+
+    def delete(self, key, version=None):
+        self.backend.delete(key, version=version)
+        with self._lock:
+            self._entries.pop(self.backend.make_key(key, version), None)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :returns: dict of tier ('memory' or 'backend') -> dict of hits and misses
+        """
+        with self._lock:
+            return {tier: {'hits': c['hits'], 'misses': c['misses']} for tier, c in self._stats.items()}
+
+    def _remember(self, full_key, value, timeout=None):
+        """
+        :param timeout: the backend's timeout for the entry, None for forever
+        """
+        if timeout is not None and timeout <= 0:
+            self._entries.pop(full_key, None)
+            return
+        timeout = self.timeout if timeout is None else min(self.timeout, timeout)
+        self._entries[full_key] = (time.monotonic() + timeout, value)
+        self._entries.move_to_end(full_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,73 @@
+"""
+Response bodies compressed ahead of time.
+
+Large API bodies that only change when their data does are compressed once,
+when they are built and cached, rather than on every response. The encoding
+sent is picked from the request's Accept-Encoding.
+"""
+import gzip
+
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# in order of preference, when the client accepts several equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def parse_accept_encoding(header):
+    """
+    :returns: dict of content coding -> q value
+    """
+    codings = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        codings[coding] = q
+    return codings
+
+
+def negotiate_encoding(request):
+    """
+    :returns: the precompressed encoding to send, or 'identity'
+    """
+    accepted = parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    best, best_q = 'identity', 0
+    for encoding in ENCODINGS:
+        q = accepted.get(encoding, accepted.get('*', 0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class PrecompressedBody:
+    """
+    A response body together with its compressed encodings
+    """
+
+    def __init__(self, content, content_type='application/json'):
+        self.content_type = content_type
+        self.variants = {'identity': content, 'gzip': gzip.compress(content)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(content, mode=brotli.MODE_TEXT)
+
+    def response(self, request):
+        encoding = negotiate_encoding(request)
+        response = HttpResponse(self.variants[encoding], content_type=self.content_type)
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
@@ -1,7 +1,14 @@
-from django.core.mail import EmailMultiAlternatives
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
 from django.template.loader import render_to_string
 
+import logging
+log = logging.getLogger(__name__)
+
 
 def build_email_message(subject, text_message, recipient_list, html_message=None):
     """
@@ -60,3 +67,103 @@ def ses_send_templated_mail(template, recipient_list, context={}):
     """
     subject, message = render_to_string(template, context).split('--END SUBJECT--')
     return ses_send_mail(subject.strip(), message, recipient_list)
+
+
+class RateLimiter:
+    """
+    Spread calls out evenly so no more than `rate` happen per second.
+
+    Thread safe. A rate of 0 or None disables limiting.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            send_at = max(self.next_time, now)
+            self.next_time = send_at + self.interval
+        if send_at > now:
+            time.sleep(send_at - now)
+
+
+class SMTPConnectionPool:
+    """
+    Send emails over several SMTP connections in parallel.
+
+    A single SMTP session is bounded by its round trip latency, one message
+    at a time. This fans messages out to a pool of worker threads, each of
+    which opens its own connection on first use and keeps it open until the
+    pool is closed. Sending is throttled to the `EMAIL_MAX_SEND_RATE` setting,
+    which should match the SES sending quota.
+
+    Use as a context manager:
+
+        with SMTPConnectionPool() as pool:
+            results = pool.send_messages(messages)
+
+    """
+
+    def __init__(self, size=None, rate=None, connection_factory=get_connection):
+        self.size = size or settings.EMAIL_POOL_SIZE
+        self.limiter = RateLimiter(settings.EMAIL_MAX_SEND_RATE if rate is None else rate)
+        self.connection_factory = connection_factory
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __enter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.size)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connection_factory()
+            connection.open()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _send(self, message):
+        self.limiter.wait()
+        try:
+            connection = self._get_connection()
+            return bool(connection.send_messages([message]))
+        except Exception:
+            log.exception('Failed to send email to %s', ', '.join(message.to))
+            # drop a possibly broken SMTP session, a new one is opened on next send
+            connection = getattr(self._local, 'connection', None)
+            if connection is not None:
+                self._local.connection = None
+                with self._lock:
+                    self._connections.remove(connection)
+                connection.close()
+            return False
+
+    def send_messages(self, messages):
+        """
+        Send messages concurrently.
+
+        :returns: list of booleans, whether each message was sent, in order
+        """
+        return list(self._executor.map(self._send, messages))
@@ -0,0 +1,95 @@
+import socketserver
+import threading
+import time
+
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.management.base import BaseCommand
+
+from apps.base.mail import build_email_message, SMTPConnectionPool
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept mail from Django's smtp backend.
+
+    Each message is held for `server.latency` seconds after DATA to mimic
+    the round trip to SES.
+    """
+
+    def reply(self, line):
+        self.wfile.write('{}\r\n'.format(line).encode('ascii'))
+
+    def handle(self):
+        self.reply('220 localhost stand-in ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                time.sleep(self.server.latency)
+                self.server.received += 1
+                self.reply('250 OK queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency):
+        super().__init__(('127.0.0.1', 0), StandInSMTPHandler)
+        self.latency = latency
+        self.received = 0
+
+
+class Command(BaseCommand):
+    help = 'Measure notification email throughput at different SMTP pool sizes, against a local stand-in server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--sizes', default='1,2,4,8',
+                            help='comma separated pool sizes to try')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='seconds the stand-in server takes to accept each message')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='messages per second limit, 0 for unlimited')
+
+    def handle(self, *args, **options):
+        server = StandInSMTPServer(options['latency'])
+        host, port = server.server_address
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def connection_factory():
+            return EmailBackend(host=host, port=port, username='', password='',
+                                use_tls=False, use_ssl=False)
+
+        messages = [
+            build_email_message('Benchmark', 'Benchmark message', ['user{}@example.com'.format(i)])
+            for i in range(options['messages'])
+        ]
+
+        try:
+            for size in [int(s) for s in options['sizes'].split(',')]:
+                server.received = 0
+                start = time.monotonic()
+                with SMTPConnectionPool(size=size, rate=options['rate'],
+                                        connection_factory=connection_factory) as pool:
+                    results = pool.send_messages(messages)
+                elapsed = time.monotonic() - start
+                self.stdout.write('pool size {:>3}: {:>4} sent, {:>4} received, {:8.1f} messages/s'.format(
+                    size, sum(results), server.received, len(messages) / elapsed))
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import reverse
+
+from apps.base.models import SiteLocker
+from apps.base.upstream import get_client
+from apps.services_near_me.services import ServiceLookupManager
+from apps.timeline.views import get_timeline_content
+
+import logging
+log = logging.getLogger(__name__)
+
+# what a browser sends, so the responses cached are the ones served
+REQUEST_HEADERS = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip, deflate, br',
+}
+
+
+class Command(BaseCommand):
+    help = "Refresh service data and timeline content concurrently, then request the API endpoints, " \
+           "run after deploy and from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='number of sources fetched at once')
+        parser.add_argument('--no-requests', action='store_false', dest='requests',
+                            help="don't request the API endpoints afterwards, to check they are served and "
+                                 "build their responses in the workers that serve them")
+
+    def handle(self, *args, **options):
+        # we have multiple instances in AWS sharing one database,
+        # only the live instance needs to refresh.
+        if not SiteLocker().is_live():
+            sys.exit(0)
+
+        manager = ServiceLookupManager()
+        family_ids = [c for c in manager.service_category_names if manager.is_family_services(c)]
+
+        # family services categories come from one CKAN query, so they're one source
+        sources = [('family services', lambda: self.refresh_categories(manager, family_ids))]
+        sources.extend(
+            (category_id, lambda category_id=category_id: self.refresh_categories(manager, [category_id]))
+            for category_id in manager.service_category_names if category_id not in family_ids
+        )
+        sources.append(('timeline', lambda: get_timeline_content(refresh=True)))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            results = list(executor.map(lambda source: self.run_source(*source), sources))
+        self.report(results, time.perf_counter() - start)
+
+        if options['requests']:
+            paths = [reverse('services_near_me:service_locations', kwargs={'category': c})
+                     for c in manager.service_category_names]
+            paths.append(reverse('timeline:timeline_content'))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                responses = list(executor.map(lambda path: self.run_source(path, self.request, path), paths))
+            self.report(responses, time.perf_counter() - start)
+            results.extend(responses)
+
+        failed = [name for name, error, _ in results if error is not None]
+        if failed:
+            raise CommandError('Failed to warm: {}'.format(', '.join(failed)))
+
+    def refresh_categories(self, manager, category_ids):
+        _, errors = manager.refresh_categories(category_ids)
+        if errors:
+            raise next(iter(errors.values()))
+
+    def request(self, path):
+        get_client('site').get(urljoin(settings.SITE_URL, path), headers=REQUEST_HEADERS).raise_for_status()
+
+    def run_source(self, name, func, *args):
+        """
+        :returns: tuple of (name, exception or None, seconds taken)
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            func(*args)
+        except Exception as e:
+            log.error('Failed to warm %s: %s', name, e)
+            error = e
+        finally:
+            # each thread has its own connection
+            connection.close()
+        return name, error, time.perf_counter() - start
+
+    def report(self, results, elapsed):
+        for name, error, seconds in results:
+            self.stdout.write('{:<40} {:<6} {:8.0f} ms'.format(name, 'FAILED' if error else 'ok', seconds * 1000))
+        self.stdout.write('{:<40} {:<6} {:8.0f} ms'.format('total', '', elapsed * 1000))
@@ -1,6 +1,21 @@
+import gzip
 import json
-from django.test import TestCase, override_settings
+import time
+from unittest import mock
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command, CommandError
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from rest_framework.views import APIView
 from apps.accounts.models import UserProxy
+from apps.base import compression
+from apps.base.cache import TieredCache
+from apps.base.mail import SMTPConnectionPool
+from apps.base.views import ConditionalGetMixin
+from apps.base.upstream import get_client, make_retry
+from apps.services_near_me.exceptions import CKANException
+from apps.services_near_me.services import ServiceLookupManager
 
 
 class BaseTestCase(TestCase):
@@ -50,3 +65,165 @@ class GenericTestCase(BaseTestCase):
         url = '/make_live/1234/'
         r = self.client.get(url.format('invalid-site-hash'))
         self.assertEqual(r.status_code, 200)
+
+
+class CompressionTestCase(SimpleTestCase):
+
+    def get(self, body, accept_encoding):
+        return body.response(RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding))
+
+    def test_negotiate(self):
+        body = compression.PrecompressedBody(b'{"a": "' + b'b' * 1000 + b'"}')
+
+        r = self.get(body, 'gzip, deflate')
+        self.assertEqual(r['Content-Encoding'], 'gzip')
+        self.assertEqual(r['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(r.content), body.variants['identity'])
+
+        r = self.get(body, 'gzip;q=0, deflate')
+        self.assertFalse(r.has_header('Content-Encoding'))
+        self.assertEqual(r.content, body.variants['identity'])
+
+        r = self.get(body, '')
+        self.assertFalse(r.has_header('Content-Encoding'))
+
+        if compression.brotli is not None:
+            r = self.get(body, 'gzip, deflate, br')
+            self.assertEqual(r['Content-Encoding'], 'br')
+            self.assertEqual(compression.brotli.decompress(r.content), body.variants['identity'])
+            self.assertEqual(self.get(body, 'gzip, br;q=0.5')['Content-Encoding'], 'gzip')
+
+
+class ConditionalGetTestCase(SimpleTestCase):
+
+    def test_missing_etag_parts(self):
+        class UnversionedView(ConditionalGetMixin, APIView):
+            permission_classes = ()
+
+            def get(self, request):
+                return HttpResponse()
+
+        with self.assertRaisesMessage(ImproperlyConfigured, 'UnversionedView must implement get_etag_parts()'):
+            UnversionedView.as_view()(RequestFactory().get('/'))
+
+
+class TieredCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.backend = LocMemCache('tiered-cache-test', {})
+        self.backend.clear()
+        self.cache = TieredCache(self.backend, max_entries=2, timeout=60)
+
+    def test_tiers(self):
+        self.backend.set('cold', [1, 2])
+        self.assertEqual(self.cache.get('cold'), [1, 2])
+        self.assertEqual(self.cache.get('cold'), [1, 2])
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual(self.cache.stats(), {
+            'memory': {'hits': 1, 'misses': 2},
+            'backend': {'hits': 1, 'misses': 1},
+        })
+
+        # writes go through to the backend, in the backend's versions
+        self.cache.set_many({'a': 1, 'b': 2}, None)
+        self.cache.set('a', 3, version=2)
+        self.assertEqual(self.backend.get_many(['a', 'b']), {'a': 1, 'b': 2})
+        self.assertEqual(self.cache.get('a', version=2), 3)
+        self.assertEqual(self.cache.get_many(['a', 'b', 'missing']), {'a': 1, 'b': 2})
+
+    def test_lru(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+        # a was least recently used, so only the backend has it
+        self.backend.set('a', 'changed')
+        self.assertEqual(self.cache.get('c'), 'c')
+        self.assertEqual(self.cache.get('a'), 'changed')
+
+    def test_timeout(self):
+        self.cache.set('a', 1)
+        self.backend.set('a', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        with mock.patch('apps.base.cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(self.cache.get('a'), 2)
+
+    def test_backend_timeout(self):
+        # not held in memory longer than the backend holds it
+        self.cache.set('a', 1, 10)
+        self.backend.set('a', 2)
+        with mock.patch('apps.base.cache.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertEqual(self.cache.get('a'), 2)
+
+        self.cache.set('b', 1, 0)
+        self.assertIsNone(self.cache.get('b'))
+
+
+class SMTPConnectionPoolTestCase(SimpleTestCase):
+
+    def test_reconnect_after_error(self):
+        connections = []
+
+        def connection_factory():
+            connection = mock.Mock()
+            connection.send_messages.side_effect = [OSError('connection lost')] if not connections else None
+            connection.send_messages.return_value = 1
+            connections.append(connection)
+            return connection
+
+        message = mock.Mock(to=['test@example.com'])
+        with SMTPConnectionPool(size=1, rate=0, connection_factory=connection_factory) as pool:
+            self.assertEqual(pool.send_messages([message, message, message]), [False, True, True])
+
+        # the broken connection was replaced by one that was kept open for the rest
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(connections[1].send_messages.call_count, 2)
+        for connection in connections:
+            connection.close.assert_called_once_with()
+
+
+class UpstreamRetryTestCase(SimpleTestCase):
+
+    def test_retry_methods(self):
+        retry = make_retry(2, 0, ('GET',))
+        self.assertTrue(retry.is_retry('GET', 503))
+        self.assertFalse(retry.is_retry('POST', 503))
+        self.assertFalse(retry.is_retry('GET', 404))
+
+    def test_connection_only(self):
+        # e.g. RealMe token requests, which mustn't be sent twice
+        retry = make_retry(2, 0, ())
+        self.assertFalse(retry.is_retry('POST', 503))
+        self.assertEqual(retry.connect, 2)
+        self.assertIs(retry.read, False)
+
+    def test_shared_clients(self):
+        client = get_client('test', retry_methods=('GET', 'POST'))
+        self.assertIs(get_client('test', retry_methods=('GET', 'POST')), client)
+        # different options are a different client, rather than being ignored
+        self.assertIsNot(get_client('test'), client)
+        self.assertIsNot(get_client('test', retry_methods=('GET', 'POST'), timeout=1), client)
+        self.assertEqual(get_client('test', timeout=1).timeout, 1)
+
+
+@mock.patch('apps.base.management.commands.warm_caches.get_timeline_content')
+@mock.patch('apps.base.management.commands.warm_caches.SiteLocker.is_live', return_value=True)
+class WarmCachesTestCase(SimpleTestCase):
+
+    def test_sources(self, is_live, get_timeline_content):
+        with mock.patch.object(ServiceLookupManager, 'refresh_categories', return_value=({}, {})) as refresh:
+            call_command('warm_caches', '--no-requests', stdout=mock.Mock())
+
+        # family services are refreshed together, in one CKAN pass
+        refreshed = sorted(tuple(c[0][0]) for c in refresh.call_args_list)
+        self.assertEqual(len(refreshed), 3)
+        self.assertIn(('early-education',), refreshed)
+        self.assertIn(('primary-schools',), refreshed)
+        get_timeline_content.assert_called_once_with(refresh=True)
+
+    def test_failure(self, is_live, get_timeline_content):
+        def refresh_categories(category_ids):
+            errors = {c: CKANException('down') for c in category_ids if c == 'primary-schools'}
+            return {}, errors
+
+        with mock.patch.object(ServiceLookupManager, 'refresh_categories', side_effect=refresh_categories):
+            with self.assertRaisesMessage(CommandError, 'primary-schools'):
+                call_command('warm_caches', '--no-requests', stdout=mock.Mock())
@@ -0,0 +1,116 @@
+"""
+Shared HTTP client for the upstream APIs: CKAN, the govt.nz timeline content
+and RealMe.
+
+Each upstream gets its own `requests.Session`, so connections are kept alive
+and reused from a pool per host rather than a new TCP and TLS handshake for
+every request. Requests time out rather than hang a worker, failures are
+retried a bounded number of times with backoff, and the latency of each
+request is logged against the upstream's name.
+"""
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+# responses that are worth trying again
+RETRY_STATUSES = (502, 503, 504)
+
+
+def make_retry(retries, backoff, methods):
+    """
+    :param methods: methods safe to send again after the request went out.
+                    Others are only retried if the connection failed.
+    """
+    if not methods:
+        # read errors are raised as they are, and no status is retried
+        return Retry(total=retries, connect=retries, read=False, status_forcelist=(), backoff_factor=backoff)
+
+    options = {
+        'total': retries,
+        'backoff_factor': backoff,
+        'status_forcelist': RETRY_STATUSES,
+        'raise_on_status': False,
+    }
+    # renamed in urllib3 1.26
+    if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS'):
+        options['allowed_methods'] = frozenset(methods)
+    else:
+        options['method_whitelist'] = frozenset(methods)
+    return Retry(**options)
+
+
+class UpstreamClient:
+    """
+    HTTP client for one upstream API
+    """
+
+    def __init__(self, name, cert=None, retry_methods=('GET', 'HEAD'), timeout=None, retries=None,
+                 pool_size=10):
+        """
+        :param name: what to call the upstream in logs
+        :param cert: client certificate for mutual TLS, as for requests
+        :param retry_methods: methods that are safe to retry after the request was sent
+        """
+        self.name = name
+        self.timeout = timeout or settings.UPSTREAM_TIMEOUT
+        retries = settings.UPSTREAM_RETRIES if retries is None else retries
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=make_retry(retries, settings.UPSTREAM_RETRY_BACKOFF, retry_methods),
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if cert:
+            self.session.cert = cert
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        parts = urlsplit(url)
+        target = '{} {}{}'.format(method, parts.netloc, parts.path)
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            log.warning('%s: %s failed after %.0f ms: %s',
+                        self.name, target, (time.monotonic() - start) * 1000, e)
+            raise
+        log.info('%s: %s %d in %.0f ms',
+                 self.name, target, response.status_code, (time.monotonic() - start) * 1000)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name, **options):
+    """
+    The shared client for an upstream, created on first use.
+
+    :param name: the upstream's name
+    :param options: UpstreamClient options. Each set of options used for an
+                    upstream gets its own client.
+    """
+    key = (name,) + tuple(sorted(
+        (option, tuple(value) if isinstance(value, list) else value) for option, value in options.items()))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = UpstreamClient(name, **options)
+        return _clients[key]
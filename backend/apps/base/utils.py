@@ -1,7 +1,12 @@
 import base64
+import hashlib
+import zlib
+from contextlib import contextmanager
 from urllib.parse import urljoin
 from django.conf import settings
+from django.db import connection
 from django.template import Template, Context
+from django.utils.http import quote_etag
 from path import Path
 
 
@@ -18,6 +23,36 @@ def get_logo_img_data():
     return base64.encodebytes(logo_path.bytes())
 
 
+def make_etag(*parts):
+    """Make a strong ETag from the values a response depends on, rather than its body"""
+    value = ':'.join(str(part) for part in parts)
+    return quote_etag(hashlib.sha1(value.encode('utf-8')).hexdigest())
+
+
 def render_string(string='', context={}):
     """Render a template string with context"""
     return Template(string).render(Context(context))
+
+
+@contextmanager
+def advisory_lock(name, wait=True):
+    """
+    Postgres session level advisory lock, shared by every process using the database.
+
+    Yields whether the lock was acquired. With wait=False it does not wait
+    for another holder to release it.
+    """
+    key = zlib.crc32(name.encode('utf-8'))
+    with connection.cursor() as cursor:
+        if wait:
+            cursor.execute('SELECT pg_advisory_lock(%s)', [key])
+            acquired = True
+        else:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [key])
+            acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [key])
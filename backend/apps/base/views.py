@@ -1,6 +1,10 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
 from .models import SiteLocker
+from .utils import make_etag
 
 
 def make_live_view(request, site_hash):
@@ -13,3 +17,49 @@ def make_live_view(request, site_hash):
         locker.make_live()
         return HttpResponse(status=200, content='OK')
     return HttpResponse(status=404)
+
+
+class ConditionalResponse(Exception):
+    """Raised to answer a request from its validators alone, without running the view"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+class ConditionalGetMixin:
+    """
+    ETag and If-None-Match support for read only API views.
+
+    Subclasses implement `get_etag_parts`, returning whatever the response
+    body depends on, such as a dataset version. The ETag is made from those
+    together with the request path and the negotiated format, so it is known
+    before any data is loaded or serialized and a client that already has the
+    current version gets a 304 straight away.
+    """
+
+    def get_etag_parts(self):
+        raise ImproperlyConfigured(
+            '{} must implement get_etag_parts() to use ConditionalGetMixin'.format(type(self).__name__))
+
+    def get_etag(self, request):
+        return make_etag(request.get_full_path(), request.accepted_renderer.format, *self.get_etag_parts())
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = None
+        if request.method in ('GET', 'HEAD'):
+            self.etag = self.get_etag(request)
+            response = get_conditional_response(request, etag=self.etag)
+            if response is not None:
+                raise ConditionalResponse(response)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, ConditionalResponse):
+            return exc.response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code in (200, 304):
+            response['ETag'] = self.etag
+        return response
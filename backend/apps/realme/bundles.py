@@ -4,13 +4,13 @@ from django.template.loader import render_to_string
 
 import uuid
 import xmlsec
-import requests
 from lxml import etree
 from path import Path
 from datetime import datetime, timedelta
 from onelogin.saml2.constants import OneLogin_Saml2_Constants as Saml2
 from onelogin.saml2.utils import OneLogin_Saml2_Utils
 
+from apps.base.upstream import get_client
 from utils import log_me
 import logging
 log = logging.getLogger(__name__)
@@ -288,4 +288,7 @@ class Bundle(object):
             self.file_path('mutual_ssl_sp_cer'),
             self.file_path('mutual_ssl_sp_key'),
         )
-        return requests.post(URL_TOKEN_ISSUE, data=signed_xml, headers=headers, cert=cert)
+        # mutual TLS with our SP certificate. Token requests aren't sent twice,
+        # they are only retried if the connection couldn't be made.
+        client = get_client('realme', cert=cert, retry_methods=())
+        return client.post(URL_TOKEN_ISSUE, data=signed_xml, headers=headers)
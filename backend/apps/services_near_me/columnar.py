@@ -0,0 +1,171 @@
+"""
+Compact, read only, in-memory storage for a category's records.
+
+A list of CKAN record dicts repeats every key in every record and boxes every
+number. ColumnarRecords keeps one column per key instead: numbers in typed
+arrays, coordinates that CKAN returns as text in float arrays (only when the
+text converts back exactly), and other text interned. Rows are read through
+`Row`, a lightweight mapping view, so serializers and the spatial index use
+them like the original dicts.
+"""
+from array import array
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+import sys
+
+# marks a key a record didn't have
+MISSING = object()
+
+
+def freeze(value):
+    """
+    Read only version of a JSON value: dicts become mapping proxies, lists
+    tuples, and text is interned
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, dict):
+        return MappingProxyType({sys.intern(k): freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def is_float_text(value):
+    try:
+        return repr(float(value)) == value
+    except ValueError:
+        return False
+
+
+class ArrayColumn:
+    """Numbers in a typed array, with None for nulls"""
+    __slots__ = ('values', 'nulls')
+
+    def __init__(self, typecode, values):
+        self.nulls = frozenset(i for i, v in enumerate(values) if v is None)
+        self.values = array(typecode, (0 if v is None else v for v in values))
+
+    def __getitem__(self, i):
+        return None if i in self.nulls else self.values[i]
+
+
+class FloatTextColumn(ArrayColumn):
+    """Decimal numbers stored as text, kept as floats and turned back into the same text on access"""
+    __slots__ = ()
+
+    def __init__(self, values):
+        super().__init__('d', [None if v is None else float(v) for v in values])
+
+    def __getitem__(self, i):
+        return None if i in self.nulls else repr(self.values[i])
+
+
+class ObjectColumn:
+    """Any other values, frozen, with text interned"""
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = tuple(v if v is MISSING else freeze(v) for v in values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+
+def make_column(values):
+    """
+    :param values: a column's values, MISSING where the record didn't have the key
+    :returns: the most compact column that gives back the same values
+    """
+    if not any(v is MISSING for v in values):
+        present = [v for v in values if v is not None]
+        if present:
+            try:
+                if all(type(v) is int for v in present):
+                    return ArrayColumn('q', values)
+            except OverflowError:
+                pass
+            if all(type(v) is float for v in present):
+                return ArrayColumn('d', values)
+            if all(type(v) is str and is_float_text(v) for v in present):
+                return FloatTextColumn(values)
+    return ObjectColumn(values)
+
+
+def collect_columns(records):
+    """
+    Splits records into columns in a single pass.
+
+    :param records: iterable of record dicts
+    :returns: tuple of (number of records, dict of key -> list of values,
+              MISSING where the record didn't have the key)
+    """
+    values = {}
+    count = 0
+    for record in records:
+        for key, value in record.items():
+            if key not in values:
+                values[key] = [MISSING] * count
+            values[key].append(value)
+        count += 1
+        for column in values.values():
+            if len(column) < count:
+                column.append(MISSING)
+    return count, values
+
+
+class Row(Mapping):
+    """
+    A record of a ColumnarRecords, read like the dict it was built from
+    """
+    __slots__ = ('_columns', '_index')
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    def __getitem__(self, key):
+        value = self._columns[key][self._index]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return (key for key, column in self._columns.items() if column[self._index] is not MISSING)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'Row({!r})'.format(dict(self))
+
+
+class ColumnarRecords(Sequence):
+    """
+    A category's records, stored by column.
+
+    :param records: iterable of record dicts. Records are consumed one at a
+                    time, so only their values, not the dicts, are held while
+                    building.
+    """
+
+    def __init__(self, records):
+        count, values = collect_columns(records)
+        self._length = count
+        self._columns = {sys.intern(key): make_column(column) for key, column in values.items()}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Row(self._columns, i) for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('record index out of range')
+        return Row(self._columns, index)
+
+    def __iter__(self):
+        columns = self._columns
+        return (Row(columns, i) for i in range(self._length))
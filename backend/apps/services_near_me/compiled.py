@@ -0,0 +1,105 @@
+"""
+Fast read-only serialization for the service lists.
+
+The serializers here only rename keys and do trivial conversions, but DRF
+goes through several method calls per field per record to do it. For a
+bound serializer, `compile_serializer` generates a function that does the
+same work with one line of code per field, and gives the same output as
+`serializer.to_representation`.
+"""
+from collections.abc import Mapping
+
+from rest_framework import fields as drf_fields
+from rest_framework import serializers
+
+# fields whose to_representation is a plain conversion
+CONVERSIONS = {
+    drf_fields.CharField: 'str',
+    drf_fields.EmailField: 'str',
+    drf_fields.URLField: 'str',
+    drf_fields.SlugField: 'str',
+    drf_fields.IntegerField: 'int',
+    drf_fields.FloatField: 'float',
+}
+
+# generated source -> code object
+_code_cache = {}
+
+
+def compile_serializer(serializer, mapping=True):
+    """
+    :param serializer: a serializer instance, bound to its context
+    :param mapping: whether the items are mappings, rather than objects
+    :returns: function of an item, giving the same result as
+              serializer.to_representation(item)
+    """
+    namespace = {'get_attribute': drf_fields.get_attribute}
+    lines = ['def serialize(item):']
+    keys = []
+
+    for n, field in enumerate(serializer._readable_fields):
+        name = 'v{}'.format(n)
+
+        if isinstance(field, serializers.SerializerMethodField):
+            namespace['method{}'.format(n)] = getattr(field.parent, field.method_name)
+            lines.append('    {} = method{}(item)'.format(name, n))
+            keys.append((field.field_name, name))
+            continue
+
+        if field.source == '*':
+            lines.append('    {} = item'.format(name))
+        elif mapping and len(field.source_attrs) == 1:
+            lines.append('    {} = item[{!r}]'.format(name, field.source_attrs[0]))
+        else:
+            namespace['source{}'.format(n)] = field.source_attrs
+            lines.append('    {} = get_attribute(item, source{})'.format(name, n))
+
+        if type(field) in CONVERSIONS:
+            convert = '{}({})'.format(CONVERSIONS[type(field)], name)
+        elif isinstance(field, serializers.ListSerializer):
+            namespace['child{}'.format(n)] = compile_serializer(field.child)
+            convert = '[child{}(x) for x in {}]'.format(n, name)
+        elif isinstance(field, serializers.Serializer):
+            namespace['child{}'.format(n)] = compile_serializer(field)
+            convert = 'child{}({})'.format(n, name)
+        else:
+            namespace['field{}'.format(n)] = field
+            convert = 'field{}.to_representation({})'.format(n, name)
+
+        lines.append('    if {} is not None:'.format(name))
+        lines.append('        {} = {}'.format(name, convert))
+        keys.append((field.field_name, name))
+
+    lines.append('    return {{{}}}'.format(', '.join('{!r}: {}'.format(k, v) for k, v in keys)))
+
+    source = '\n'.join(lines)
+    code = _code_cache.get(source)
+    if code is None:
+        code = _code_cache[source] = compile(source, '<{}>'.format(type(serializer).__name__), 'exec')
+    exec(code, namespace)
+    return namespace['serialize']
+
+
+def serialize_many(serializer, items):
+    """
+    Serializes items like `serializer(items, many=True).data`, only faster.
+
+    Items the compiled function can't handle, like ones missing a field, go
+    through DRF, so errors and defaults are the same as before.
+
+    :param serializer: a serializer instance, bound to its context
+    :param items: items to serialize
+    :returns: list of serialized items
+    """
+    first = next(iter(items), None)
+    if first is None:
+        return []
+
+    serialize = compile_serializer(serializer, mapping=isinstance(first, Mapping))
+    results = []
+    for item in items:
+        try:
+            results.append(serialize(item))
+        except (KeyError, AttributeError, TypeError):
+            results.append(serializer.to_representation(item))
+    return results
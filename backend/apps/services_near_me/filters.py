@@ -0,0 +1,175 @@
+"""
+Evaluate the CKAN_FILTERS WHERE expressions locally, against records in Python.
+
+Only the subset of SQL the filters use is supported:
+
+    "COLUMN" [NOT] LIKE 'pattern'
+    LOWER("COLUMN") [NOT] LIKE 'pattern'
+
+combined with AND, OR and parentheses. Evaluation follows SQL three-valued
+logic, so a NULL column gives the same result as in the database: the
+comparison is unknown, and a record only matches if the whole expression
+is true.
+"""
+import re
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<ident>"(?:[^"]|"")*")
+      | (?P<string>'(?:[^']|'')*')
+      | (?P<punct>[()])
+      | (?P<word>[A-Za-z_]+)
+    )''', re.VERBOSE)
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def tokenize(sql):
+    tokens = []
+    pos = 0
+    sql = sql.strip()
+    while pos < len(sql):
+        match = TOKEN_RE.match(sql, pos)
+        if not match:
+            raise FilterSyntaxError('Unexpected input at {}: {!r}'.format(pos, sql[pos:pos + 20]))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'ident':
+            value = value[1:-1].replace('""', '"')
+        elif kind == 'string':
+            value = value[1:-1].replace("''", "'")
+        elif kind == 'word':
+            value = value.upper()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+def like_to_regex(pattern):
+    """Translate a LIKE pattern, with the default backslash escape, to a regex"""
+    regex = []
+    chars = iter(pattern)
+    for c in chars:
+        if c == '\\':
+            regex.append(re.escape(next(chars, '\\')))
+        elif c == '%':
+            regex.append('.*')
+        elif c == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(c))
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+
+def sql_and(values):
+    result = True
+    for value in values:
+        if value is False:
+            return False
+        if value is None:
+            result = None
+    return result
+
+
+def sql_or(values):
+    result = False
+    for value in values:
+        if value is True:
+            return True
+        if value is None:
+            result = None
+    return result
+
+
+class Parser:
+
+    def __init__(self, sql):
+        self.tokens = tokenize(sql)
+        self.pos = 0
+        self.columns = set()
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            raise FilterSyntaxError('Expected {} at token {}, got {!r}'.format(value or kind, self.pos, token[1]))
+        self.pos += 1
+        return token[1]
+
+    def parse(self):
+        expr = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise FilterSyntaxError('Unexpected {!r} at token {}'.format(self.peek()[1], self.pos))
+        return expr
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == ('word', 'OR'):
+            self.take()
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda record: sql_or(term(record) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_atom()]
+        while self.peek() == ('word', 'AND'):
+            self.take()
+            terms.append(self.parse_atom())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda record: sql_and(term(record) for term in terms)
+
+    def parse_atom(self):
+        if self.peek() == ('punct', '('):
+            self.take()
+            expr = self.parse_or()
+            self.take('punct', ')')
+            return expr
+        return self.parse_like()
+
+    def parse_like(self):
+        lower = self.peek() == ('word', 'LOWER')
+        if lower:
+            self.take()
+            self.take('punct', '(')
+            column = self.take('ident')
+            self.take('punct', ')')
+        else:
+            column = self.take('ident')
+        self.columns.add(column)
+
+        negate = self.peek() == ('word', 'NOT')
+        if negate:
+            self.take()
+        self.take('word', 'LIKE')
+        regex = like_to_regex(self.take('string'))
+
+        def like(record):
+            value = record.get(column)
+            if value is None:
+                return None
+            value = str(value)
+            if lower:
+                value = value.lower()
+            return (regex.match(value) is None) if negate else (regex.match(value) is not None)
+        return like
+
+
+class CompiledFilter:
+    """
+    A CKAN filter expression compiled to a Python predicate on a record dict
+    """
+
+    def __init__(self, sql):
+        parser = Parser(sql)
+        self.expression = parser.parse()
+        # columns the records need for the filter to be evaluated
+        self.columns = parser.columns
+
+    def __call__(self, record):
+        return self.expression(record) is True
@@ -0,0 +1,147 @@
+"""
+Incremental parsing of large JSON responses.
+
+`response.json()` needs the whole body, its decoded text and every parsed
+record in memory at once. `iter_items` instead reads the body a chunk at a
+time and yields the items of one array in it as each is parsed, so only the
+current chunk and the records kept by the caller are held.
+"""
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+
+class JSONStream:
+    """
+    Reads JSON values one at a time from an iterable of text chunks
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.finished = False
+
+    def fill(self):
+        """
+        Reads the next chunk onto the end of the buffer, dropping what has
+        already been parsed.
+
+        :returns: False if there is nothing more to read
+        """
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        self.finished = True
+        return False
+
+    def peek(self):
+        """
+        :returns: the next character that isn't whitespace, without consuming it
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {!r} at {!r}'.format(char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        """
+        Parses the next complete value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # the value may carry on in the next chunk
+                if not self.fill():
+                    raise
+                continue
+            # a number at the very end of the buffer may have more digits to come
+            if end == len(self.buffer) and not self.finished and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def object_keys(self):
+        """
+        Reads the keys of an object, leaving the value of each for the caller
+        to read or `skip` before the next key is read.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+    def array_items(self):
+        """
+        Parses the items of an array one at a time.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def skip(self):
+        self.value()
+
+
+def iter_items(chunks, path):
+    """
+    Yields the items of the array found at path, e.g. ('result', 'records')
+    for CKAN's records, as they are parsed.
+
+    :param chunks: iterable of text chunks
+    :param path: keys leading to the array from the top level object
+    """
+    stream = JSONStream(chunks)
+    for depth, key in enumerate(path):
+        for found in stream.object_keys():
+            if found == key:
+                break
+            stream.skip()
+        else:
+            raise ValueError('No {!r} in JSON'.format('.'.join(path[:depth + 1])))
+    yield from stream.array_items()
+
+
+def iter_response_items(response, path, chunk_size=CHUNK_SIZE):
+    """
+    `iter_items` over a streamed requests response. JSON is UTF-8 whatever
+    the response's content type says.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = (decoder.decode(chunk) for chunk in response.iter_content(chunk_size))
+    return iter_items(chunks, path)
@@ -0,0 +1,45 @@
+"""
+Generated service records, for benchmarking without the stored CKAN data
+"""
+import json
+import random
+
+
+def synthetic_datasets(count):
+    """Records shaped like the stored CKAN data, `count` of each kind"""
+    rnd = random.Random(0)
+
+    def text(words):
+        return ' '.join(rnd.choice(['whanau', 'support', 'family', 'health', 'service', 'community',
+                                    'parenting', 'programme', 'Wellington', 'free']) for _ in range(words))
+
+    def coordinate(low, high):
+        return repr(round(rnd.uniform(low, high), 6))
+
+    providers = [{
+        'FSD_ID': i, 'PROVIDER_NAME': text(3), 'ORGANISATION_PURPOSE': text(60),
+        'PHYSICAL_ADDRESS': text(6), 'LATITUDE': coordinate(-46.5, -34.5), 'LONGITUDE': coordinate(166.5, 178.5),
+        'PROVIDER_WEBSITE_1': 'http://example{}.org.nz'.format(i), 'PUBLISHED_CONTACT_EMAIL_1': 'info@example.org.nz',
+        'PUBLISHED_PHONE_1': '(04) 555 {:04}'.format(i % 10000), 'PROVIDER_CONTACT_AVAILABILITY': text(5),
+        'services': [{'SERVICE_ID': i * 10 + s, 'SERVICE_NAME': text(3), 'SERVICE_DETAIL': text(40)}
+                     for s in range(rnd.randint(1, 3))],
+    } for i in range(count)]
+    schools = [{
+        'School_Id': i, 'Org_Name': text(2) + ' School', 'Org_Type': 'Full Primary', 'Definition': text(8),
+        'Total': rnd.randint(10, 700), 'Add1_Line1': text(3), 'Add1_Suburb': text(1), 'Add1_City': text(1),
+        'Latitude': rnd.uniform(-46.5, -34.5), 'Longitude': rnd.uniform(166.5, 178.5),
+        'URL': 'http://school{}.school.nz'.format(i), 'Telephone': '04 555 {:04}'.format(i % 10000),
+        'Email': 'office@school{}.school.nz'.format(i),
+    } for i in range(count)]
+    early_education = [{
+        'ECE_Id': i, 'Org_Name': text(2) + ' Kindergarten', 'Org_Type': 'Free Kindergarten', 'Definition': text(8),
+        'All_Children': rnd.randint(10, 80), 'Add1_Line1': text(3), 'Add1_Suburb': text(1), 'Add1_City': text(1),
+        'Latitude': rnd.uniform(-46.5, -34.5), 'Longitude': rnd.uniform(166.5, 178.5),
+        'Telephone': '04 555 {:04}'.format(i % 10000), 'Email': 'kindy{}@example.org.nz'.format(i),
+        '20_Hrs_ECE': rnd.choice(['Yes', 'No', None]),
+    } for i in range(count)]
+    return {
+        'family-services': [json.dumps(r) for r in providers],
+        'primary-schools': [json.dumps(r) for r in schools],
+        'early-education': [json.dumps(r) for r in early_education],
+    }
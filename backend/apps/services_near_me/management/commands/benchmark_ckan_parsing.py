@@ -0,0 +1,155 @@
+import gc
+import io
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from apps.base.upstream import get_client
+from apps.services_near_me.constants import CKAN_FILTERS
+from apps.services_near_me.jsonstream import CHUNK_SIZE, iter_response_items
+from apps.services_near_me.services import FamilyServicesDataSource, ServiceLookupManager
+from apps.services_near_me.snapshot import SnapshotStore
+from ._synthetic import synthetic_datasets
+
+LEVEL_2_CATEGORIES = [
+    'Babies and Toddlers 0-5', 'Budgeting', 'Well Child Health (Tamariki Ora)', 'Breast Feeding Support',
+    'Antenatal Classes', 'Mental Health - Depression', 'Elderly - Support Services', 'Youth Services',
+]
+
+
+class RecordedResponse:
+    """Just enough of a requests response to stream a recorded body"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        stream = io.BytesIO(self.body)
+        return iter(lambda: stream.read(chunk_size), b'')
+
+
+def synthetic_response(count):
+    """
+    A datastore_search_sql response for the full family services query,
+    a row per service and category, as CKAN returns it
+    """
+    rnd = random.Random(0)
+    rows = []
+    for text in synthetic_datasets(count)['family-services']:
+        provider = json.loads(text)
+        for service in provider.pop('services'):
+            for category in rnd.sample(LEVEL_2_CATEGORIES, rnd.randint(1, 3)):
+                rows.append(dict(provider, LEVEL_2_CATEGORY=category, **service))
+    return json.dumps({'success': True, 'result': {'records': rows}}).encode('utf-8')
+
+
+class Command(BaseCommand):
+    help = "Compare the peak memory of the family services refresh query, parsing CKAN's response " \
+           "whole as response.json() does, and streamed. With --refresh, across the whole refresh."
+
+    def add_arguments(self, parser):
+        parser.add_argument('response', nargs='?',
+                            help='file holding a recorded response to the full family services query')
+        parser.add_argument('--record', metavar='FILE',
+                            help='run the query against CKAN and save the response to FILE')
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='use a generated response for this many providers instead')
+        parser.add_argument('--refresh', action='store_true',
+                            help='measure the whole refresh: parsing, grouping, checksums, storing the records '
+                                 'and writing snapshots. The records are stored in a transaction that is rolled '
+                                 'back, and the snapshots written to a temporary directory.')
+
+    def handle(self, *args, **options):
+        manager = ServiceLookupManager()
+        family_ids = [c for c in manager.service_category_names if manager.is_family_services(c)]
+        data_source = FamilyServicesDataSource(settings.FAMILY_SERVICES_RESOURCE)
+
+        if options['record']:
+            self.record(data_source.build_all_query(family_ids), options['record'])
+            return
+
+        if options['synthetic']:
+            body = synthetic_response(options['synthetic'])
+        elif options['response']:
+            with open(options['response'], 'rb') as f:
+                body = f.read()
+        else:
+            raise CommandError('Give a recorded response, --record one, or use --synthetic')
+
+        def parse_whole(sql):
+            # what response.json() does: decode the whole body, then parse it
+            return iter(json.loads(body.decode('utf-8'))['result']['records'])
+
+        def parse_streamed(sql):
+            return iter_response_items(RecordedResponse(body), ('result', 'records'))
+
+        # parsing whole also holds the body until response.json() returns,
+        # streamed only holds a chunk of it at a time
+        outputs = []
+        for name, parse, held in [('whole', parse_whole, len(body)), ('streamed', parse_streamed, 0)]:
+            data_source.stream_query = parse
+            results, peak, seconds = measure(lambda: data_source.query_all_services(family_ids))
+
+            outputs.append(results)
+            self.stdout.write('{:<10} {:>7} records kept: peak {:8.2f} MB  {:8.1f} ms'.format(
+                name, sum(len(r) for r in results.values()), (peak + held) / 2 ** 20, seconds * 1000))
+            del results
+
+        self.stdout.write('response   {:8.2f} MB{}'.format(
+            len(body) / 2 ** 20, '' if outputs[0] == outputs[1] else '  OUTPUT DIFFERS'))
+        del outputs
+
+        if options['refresh']:
+            for name, parse, held in [('whole', parse_whole, len(body)), ('streamed', parse_streamed, 0)]:
+                with tempfile.TemporaryDirectory() as directory:
+                    datasets, peak, seconds = self.refresh(family_ids, parse, directory)
+                self.stdout.write('{:<10} {:>7} records stored: peak {:6.2f} MB  {:8.1f} ms'.format(
+                    name, sum(d.record_count for d in datasets.values()), (peak + held) / 2 ** 20, seconds * 1000))
+
+    def refresh(self, family_ids, parse, directory):
+        """
+        Runs the family services refresh with its CKAN query answered by parse
+
+        :returns: tuple of (datasets, peak memory, seconds)
+        """
+        manager = ServiceLookupManager()
+        manager.snapshots = SnapshotStore(directory)
+        data_source = manager._family_services
+        data_source.stream_query = parse
+        data_source.resource_version = lambda: 'benchmark'
+        query = '\n'.join([data_source.build_all_query(family_ids)] + [CKAN_FILTERS[c] for c in family_ids])
+
+        with transaction.atomic():
+            result = measure(lambda: manager._refresh(
+                data_source, family_ids, lambda: manager.fetch_family_services(family_ids), query))
+            transaction.set_rollback(True)
+        return result
+
+    def record(self, sql, path):
+        r = get_client('ckan', retry_methods=('GET', 'POST')).post(
+            settings.CKAN_QUERY_URL, files={'sql': (None, sql)}, stream=True)
+        r.raise_for_status()
+        with r, open(path, 'wb') as f:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                f.write(chunk)
+        self.stdout.write('Saved the response to {}'.format(path))
+
+
+def measure(func):
+    """
+    :returns: tuple of (func's result, peak memory allocated while it ran, seconds)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[1], time.perf_counter() - start
+    finally:
+        tracemalloc.stop()
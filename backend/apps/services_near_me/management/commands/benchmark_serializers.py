@@ -0,0 +1,67 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from apps.services_near_me import serializers
+from apps.services_near_me.columnar import ColumnarRecords
+from apps.services_near_me.compiled import serialize_many
+from apps.services_near_me.models import CategoryDataset
+from apps.services_near_me.services import ServiceLookupManager
+from ._synthetic import synthetic_datasets
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+class Command(BaseCommand):
+    help = 'Compare DRF serializers with the compiled fast path on full category datasets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='use this many generated records of each kind instead of the stored data')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        manager = ServiceLookupManager()
+
+        if options['synthetic']:
+            generated = synthetic_datasets(options['synthetic'])
+            datasets = {
+                'well-child': generated['family-services'],
+                'primary-schools': generated['primary-schools'],
+                'early-education': generated['early-education'],
+            }
+        else:
+            datasets = {
+                dataset.category: [json.dumps(data) for data in dataset.records.values_list('data', flat=True)]
+                for dataset in CategoryDataset.objects.all()
+            }
+            if not datasets:
+                raise CommandError('No stored service data, run refresh_service_data or use --synthetic')
+
+        render = JSONRenderer().render
+        for category, texts in sorted(datasets.items()):
+            if manager.is_family_services(category):
+                serializer_class = serializers.ProviderSerializer
+            elif category == 'primary-schools':
+                serializer_class = serializers.SchoolSerializer
+            else:
+                serializer_class = serializers.EarlyEducationSerializer
+            items = ColumnarRecords(json.loads(text) for text in texts)
+
+            drf_time, drf_body = best_time(
+                lambda: render(serializer_class(items, many=True).data), options['repeat'])
+            fast_time, fast_body = best_time(
+                lambda: render(serialize_many(serializer_class(), items)), options['repeat'])
+
+            self.stdout.write('{:<20} {:>6} records: DRF {:8.1f} ms  compiled {:8.1f} ms  ({:.1f}x){}'.format(
+                category, len(items), drf_time * 1000, fast_time * 1000, drf_time / fast_time,
+                '' if drf_body == fast_body else '  OUTPUT DIFFERS'))
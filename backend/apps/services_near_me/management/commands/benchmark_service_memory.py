@@ -0,0 +1,98 @@
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.services_near_me.columnar import ColumnarRecords
+from apps.services_near_me.models import CategoryDataset
+from apps.services_near_me.snapshot import SnapshotRecords, write_snapshot
+from ._synthetic import synthetic_datasets
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # peak rather than current, close enough for a fresh process
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_dicts(texts):
+    return [json.loads(text) for text in texts]
+
+
+def build_columnar(texts):
+    return ColumnarRecords(json.loads(text) for text in texts)
+
+
+def build_snapshot(texts):
+    # file pages are mapped rather than allocated, and shared between workers
+    with tempfile.NamedTemporaryFile(suffix='.snap', delete=False) as f:
+        path = f.name
+    try:
+        write_snapshot(path, (json.loads(text) for text in texts))
+        return SnapshotRecords(path)
+    finally:
+        os.unlink(path)
+
+
+def rss_in_child(build, datasets, conn):
+    gc.collect()
+    before = current_rss()
+    held = [build(texts) for texts in datasets.values()]  # noqa: F841
+    gc.collect()
+    conn.send(current_rss() - before)
+    conn.close()
+
+
+class Command(BaseCommand):
+    help = 'Compare the memory used by the service records held per worker, as dicts, ColumnarRecords and snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='use this many generated records of each kind instead of the stored data')
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            datasets = synthetic_datasets(options['synthetic'])
+        else:
+            datasets = {
+                dataset.category: [json.dumps(data) for data in dataset.records.values_list('data', flat=True)]
+                for dataset in CategoryDataset.objects.all()
+            }
+            if not datasets:
+                raise CommandError('No stored service data, run refresh_service_data or use --synthetic')
+
+        builders = [('dicts', build_dicts), ('columnar', build_columnar), ('snapshot', build_snapshot)]
+
+        self.stdout.write('Python allocations held, per category (MB):')
+        for category, texts in datasets.items():
+            sizes = []
+            for _, build in builders:
+                gc.collect()
+                tracemalloc.start()
+                held = build(texts)  # noqa: F841
+                sizes.append(tracemalloc.get_traced_memory()[0])
+                tracemalloc.stop()
+                del held
+            self.stdout.write('  {:<20} {:>6} records: dicts {:8.2f}  columnar {:8.2f}  snapshot {:8.2f}'.format(
+                category, len(texts), *(size / 2 ** 20 for size in sizes)))
+
+        # RSS is measured in a fresh process for each, since memory freed by
+        # one representation would otherwise be reused by the next
+        self.stdout.write('Worker RSS growth, all categories (MB):')
+        context = multiprocessing.get_context('fork')
+        for name, build in builders:
+            parent_conn, child_conn = context.Pipe(duplex=False)
+            process = context.Process(target=rss_in_child, args=(build, datasets, child_conn))
+            process.start()
+            growth = parent_conn.recv()
+            process.join()
+            self.stdout.write('  {:<10} {:8.2f}'.format(name, growth / 2 ** 20))
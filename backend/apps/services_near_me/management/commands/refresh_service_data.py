@@ -0,0 +1,37 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from apps.base.models import SiteLocker
+from apps.services_near_me.services import ServiceLookupManager
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Copy service data from CKAN into the local store, run hourly from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument('categories', nargs='*',
+                            help='categories to refresh, all of them by default')
+
+    def handle(self, *args, **options):
+        # we have multiple instances in AWS sharing one database,
+        # only the live instance needs to refresh.
+        if not SiteLocker().is_live():
+            sys.exit(0)
+
+        manager = ServiceLookupManager()
+        categories = options['categories'] or manager.service_category_names
+        unknown = set(categories) - set(manager.service_category_names)
+        if unknown:
+            raise CommandError('Unknown categories: {}'.format(', '.join(sorted(unknown))))
+
+        datasets, errors = manager.refresh_categories(categories)
+
+        for category, dataset in datasets.items():
+            self.stdout.write('{}: {} records'.format(category, dataset.record_count))
+        for category, e in errors.items():
+            log.error('Failed to refresh %s: %s', category, e)
+
+        if errors:
+            raise CommandError('Failed to refresh: {}'.format(', '.join(errors)))
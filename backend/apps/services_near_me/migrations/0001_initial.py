@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryDataset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+                ('category', models.SlugField(unique=True)),
+                ('version', models.CharField(help_text='Checksum of the records', max_length=40)),
+                ('record_count', models.IntegerField(default=0)),
+                ('refreshed_at', models.DateTimeField(help_text='When the records were last fetched from CKAN')),
+                ('retry_at', models.DateTimeField(blank=True, help_text='When to try again after CKAN failed, until then the stale records are served without refreshing', null=True)),
+                ('source_version', models.CharField(blank=True, help_text='Modification time and row count of the CKAN resource fetched, and a checksum of the query', max_length=100)),
+            ],
+            options={
+                'ordering': ['-modified_at'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ServiceRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField(help_text="The record's id in CKAN, for updating it in place", null=True)),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='services_near_me.CategoryDataset')),
+            ],
+            options={
+                'ordering': ['key', 'id'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='servicerecord',
+            index_together=set([('dataset', 'key')]),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.contrib.postgres.fields import JSONField
+from django.db import models
+
+from apps.base.models import TimeStampedModel
+
+
+class CategoryDataset(TimeStampedModel):
+    """
+    Local copy of the CKAN records for one service category.
+
+    Filled by the `refresh_service_data` command, so the service-locations
+    views never have to wait on data.govt.nz.
+    """
+    category = models.SlugField(max_length=50, unique=True)
+    version = models.CharField(max_length=40, help_text='Checksum of the records')
+    record_count = models.IntegerField(default=0)
+    refreshed_at = models.DateTimeField(help_text='When the records were last fetched from CKAN')
+    retry_at = models.DateTimeField(null=True, blank=True,
+                                    help_text='When to try again after CKAN failed, until then the stale '
+                                              'records are served without refreshing')
+    source_version = models.CharField(max_length=100, blank=True,
+                                      help_text='Modification time and row count of the CKAN resource fetched, '
+                                                'and a checksum of the query')
+
+    def __str__(self):
+        return '{} ({} records, refreshed {})'.format(self.category, self.record_count, self.refreshed_at)
+
+
+class ServiceRecord(models.Model):
+    """
+    A CKAN record, as returned by the data source query for its category.
+    Family services are stored grouped, a record per provider.
+    """
+    dataset = models.ForeignKey(CategoryDataset, related_name='records', on_delete=models.CASCADE)
+    key = models.BigIntegerField(null=True, help_text="The record's id in CKAN, for updating it in place")
+    data = JSONField()
+
+    class Meta:
+        # records are stored in id order, or in the order the data source
+        # returned them in if they can't be told apart by id
+        ordering = ['key', 'id']
+        index_together = [('dataset', 'key')]
@@ -0,0 +1,81 @@
+import base64
+import json
+from bisect import bisect_right
+from collections import OrderedDict
+
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class IdCursorPagination(BasePagination):
+    """
+    Cursor pagination over a category's services, which are stored in id order.
+
+    The cursor is the last id of the previous page, so paging stays consistent
+    when the data is refreshed in between: nothing is skipped or repeated.
+    Pagination is only used when the request asks for it with `page_size` or
+    `cursor`, otherwise the whole list is returned.
+
+    The view provides the ids, in the same order as the items, with `get_ids()`.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    default_page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def is_requested(self, request):
+        params = request.query_params
+        return self.cursor_query_param in params or self.page_size_query_param in params
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.default_page_size))
+        except ValueError:
+            raise ValidationError('page_size must be a whole number')
+        if page_size < 1:
+            raise ValidationError('page_size must be at least 1')
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, item_id):
+        return base64.urlsafe_b64encode(json.dumps(item_id).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        try:
+            return json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+
+        self.request = request
+        ids = view.get_ids()
+        page_size = self.get_page_size(request)
+
+        start = 0
+        if self.cursor_query_param in request.query_params:
+            try:
+                start = bisect_right(ids, self.decode_cursor(request.query_params[self.cursor_query_param]))
+            except TypeError:
+                # not the same type as the ids
+                raise NotFound(self.invalid_cursor_message)
+
+        end = start + page_size
+        self.next_id = ids[end - 1] if end < len(ids) else None
+        return list(queryset[start:end])
+
+    def get_next_link(self):
+        if self.next_id is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_id))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
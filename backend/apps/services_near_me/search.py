@@ -0,0 +1,115 @@
+"""
+Keyword search over a category's services.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Mapping
+from math import log
+import re
+import unicodedata
+
+WORD_RE = re.compile(r'\w+')
+
+# a term that only matches as the start of a longer word counts for less
+PREFIX_MATCH_FACTOR = 0.5
+
+
+def tokenize(text):
+    """
+    Lower case words of the text, without diacritics so that e.g. whānau
+    and whanau are the same word
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return WORD_RE.findall(text)
+
+
+def field_values(value, keys):
+    """
+    Text found at a dotted field path, following lists along the way,
+    e.g. 'services.SERVICE_NAME' gives the name of each of the services
+    """
+    if not keys:
+        if isinstance(value, str):
+            yield value
+    elif isinstance(value, Mapping):
+        yield from field_values(value.get(keys[0]), keys[1:])
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            yield from field_values(v, keys)
+
+
+class InvertedIndex:
+    """
+    In-memory inverted index over service records.
+
+    Maps each word of the indexed fields to the records it appears in, with
+    the weight of the best field it appears in. A search matches records
+    that have every word of the query, the last word also matching as a
+    prefix so partly typed queries work. Records are scored by the field
+    weights of the words they matched, rarer words counting for more.
+    """
+
+    def __init__(self, items, fields):
+        """
+        :param items: the records to index
+        :param fields: dict of dotted field path -> weight
+        """
+        self.items = items
+        postings = defaultdict(dict)
+
+        for position, item in enumerate(items):
+            for path, weight in fields.items():
+                for text in field_values(item, path.split('.')):
+                    for term in set(tokenize(text)):
+                        if postings[term].get(position, 0) < weight:
+                            postings[term][position] = weight
+
+        self.postings = dict(postings)
+        self.terms = sorted(self.postings)
+
+    def __len__(self):
+        return len(self.items)
+
+    def matches(self, term, prefix=False):
+        """
+        :returns: dict of position -> weight of the records matching term
+        """
+        matches = dict(self.postings.get(term, {}))
+        if prefix:
+            start = bisect_left(self.terms, term)
+            for other in self.terms[start:]:
+                if not other.startswith(term):
+                    break
+                for position, weight in self.postings[other].items():
+                    weight *= PREFIX_MATCH_FACTOR
+                    if matches.get(position, 0) < weight:
+                        matches[position] = weight
+        return matches
+
+    def search(self, query, limit=None):
+        """
+        :param query: words to search for
+        :param limit: maximum number of records to return
+        :returns: list of matching records, best first
+        """
+        terms = tokenize(query)
+        scores = None
+
+        for n, term in enumerate(terms):
+            matches = self.matches(term, prefix=(n == len(terms) - 1))
+            if not matches:
+                return []
+            idf = log(1 + len(self.items) / len(matches))
+            if scores is None:
+                scores = {position: weight * idf for position, weight in matches.items()}
+            else:
+                scores = {
+                    position: score + matches[position] * idf
+                    for position, score in scores.items() if position in matches
+                }
+
+        ranked = sorted((scores or {}).items(), key=lambda s: (-s[1], s[0]))
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [self.items[position] for position, _ in ranked]
@@ -7,13 +7,26 @@ from .constants import SCHOOL_DESCRIPTION_MAPPING
 log = logging.getLogger(__name__)
 
 
+class ProjectedFieldsMixin:
+    """
+    Only serializes the fields listed in the `fields` context entry, if there is one
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
 class ServiceSerializer(serializers.Serializer):
     id = serializers.IntegerField(source='SERVICE_ID')
     name = serializers.CharField(source='SERVICE_NAME')
     detail = serializers.CharField(source='SERVICE_DETAIL')
 
 
-class ProviderSerializer(serializers.Serializer):
+class ProviderSerializer(ProjectedFieldsMixin, serializers.Serializer):
     id = serializers.IntegerField(source='FSD_ID')
     name = serializers.CharField(source='PROVIDER_NAME')
     description = serializers.CharField(source='ORGANISATION_PURPOSE')
@@ -28,7 +41,7 @@ class ProviderSerializer(serializers.Serializer):
     services = ServiceSerializer(many=True)
 
 
-class SchoolSerializer(serializers.Serializer):
+class SchoolSerializer(ProjectedFieldsMixin, serializers.Serializer):
     id = serializers.IntegerField(source='School_Id')
     name = serializers.CharField(source='Org_Name')
     type = serializers.SerializerMethodField()
@@ -50,7 +63,7 @@ class SchoolSerializer(serializers.Serializer):
         return ', '.join(filter(None, address))
 
 
-class EarlyEducationSerializer(serializers.Serializer):
+class EarlyEducationSerializer(ProjectedFieldsMixin, serializers.Serializer):
     id = serializers.IntegerField(source='ECE_Id')
     name = serializers.CharField(source='Org_Name')
     type = serializers.CharField(source='Org_Type')
@@ -77,3 +90,9 @@ class CategorySerializer(serializers.Serializer):
     id = serializers.SlugField(source='identifier')
     name = serializers.CharField()
     type = serializers.CharField(source='type.name')
+    refreshed_at = serializers.SerializerMethodField()
+
+    def get_refreshed_at(self, category):
+        # when the local copy was last updated from CKAN, null if never
+        refreshed_at = self.context['refreshed_at'].get(category.identifier)
+        return serializers.DateTimeField().to_representation(refreshed_at) if refreshed_at else None
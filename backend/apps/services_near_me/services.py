@@ -1,30 +1,43 @@
 from enum import Enum, auto
 from abc import ABC, abstractmethod
+from datetime import datetime
 from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from itertools import groupby
+from operator import itemgetter
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 
-import requests
 from requests.exceptions import HTTPError
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import timezone
 
+from apps.base.upstream import get_client
+from apps.base.utils import advisory_lock
 from apps.services_near_me.constants import CKAN_FILTERS
+from .columnar import ColumnarRecords
 from .exceptions import CKANException
+from .filters import CompiledFilter
+from .jsonstream import iter_response_items
+from .models import CategoryDataset, ServiceRecord
+from .snapshot import SnapshotStore
 
 log = logging.getLogger(__name__)
 
-# data.govt.nz don't provide any guarantees around availability.
-# Need to rely on cached API responses during outages.
-# cache CKAN responses in the DB so they will survive long-term if necessary.
-cache = caches['db']
-
 
 class CKANDataSource(ABC):
     """
     Abstract base class for data sources looking up services in CKAN
     """
+    # column uniquely identifying a service, records are stored in its order
+    id_column = None
 
     def __init__(self, resource):
         self.resource = resource
@@ -47,29 +60,80 @@ class CKANDataSource(ABC):
         :returns: the CKAN records resulting from the query
         """
 
-        sql = self.build_query(category_id)
+        return self.run_query(self.build_query(category_id))
+
+    def resource_version(self):
+        """
+        Checks the resource's metadata, without downloading it, to tell
+        whether it has changed since it was last fetched.
+
+        :returns: when the resource was last modified and how many rows it has,
+                  which change whenever it's republished
+        """
 
         try:
-            log.debug("Making CKAN query: '%s'", sql)
+            client = get_client('ckan', retry_methods=('GET', 'POST'))
+            r = client.get(settings.CKAN_RESOURCE_URL, params={'id': self.resource})
+            r.raise_for_status()
+            resource = r.json()['result']
 
-            r = requests.post(settings.CKAN_QUERY_URL, files={'sql': (None, sql)})
+            r = client.get(settings.CKAN_SEARCH_URL, params={'resource_id': self.resource, 'limit': 0})
             r.raise_for_status()
+            total = r.json()['result']['total']
 
-            json = r.json()
-            results = json['result']['records']
-            log.info('CKAN query returned %d results', len(results))
+        except Exception as e:
+            log.error('Error while checking CKAN resource %s: %s', self.resource, e)
+            raise CKANException from e
 
-            return results
+        return '{}/{}'.format(resource.get('last_modified') or resource['metadata_modified'], total)
 
-        except HTTPError as e:
-            log.error('HTTP error on CKAN request: %s', e)
-            self._log_ckan_error_from_response(r)
-            raise CKANException from e
+    def run_query(self, sql):
+        """
+        Sends a SQL query to CKAN
+
+        :param sql: the query
+        :returns: the CKAN records resulting from the query
+        """
+
+        results = list(self.stream_query(sql))
+        log.info('CKAN query returned %d results', len(results))
+        return results
+
+    def stream_query(self, sql):
+        """
+        Sends a SQL query to CKAN, and parses the records from the response
+        as it's read, so the whole response is never held in memory.
+
+        :param sql: the query
+        :returns: iterator of the CKAN records resulting from the query
+        """
+
+        try:
+            log.debug("Making CKAN query: '%s'", sql)
+
+            # queries only read, so they are safe to retry
+            r = get_client('ckan', retry_methods=('GET', 'POST')).post(
+                settings.CKAN_QUERY_URL, files={'sql': (None, sql)}, stream=True)
 
         except Exception as e:
             log.error('Error while attempting CKAN request: %s', e)
             raise CKANException from e
 
+        # closed on every way out, so its pooled connection is released
+        with r:
+            try:
+                r.raise_for_status()
+                yield from iter_response_items(r, ('result', 'records'))
+
+            except HTTPError as e:
+                log.error('HTTP error on CKAN request: %s', e)
+                self._log_ckan_error_from_response(r)
+                raise CKANException from e
+
+            except Exception as e:
+                log.error('Error while attempting CKAN request: %s', e)
+                raise CKANException from e
+
     def _log_ckan_error_from_response(self, response):
         try:
             json = response.json()
@@ -80,18 +144,30 @@ class CKANDataSource(ABC):
 
 
 class FamilyServicesDataSource(CKANDataSource):
+    id_column = 'FSD_ID'
+
+    # columns returned for every service
+    columns = [
+        'FSD_ID', 'PROVIDER_NAME', 'ORGANISATION_PURPOSE',
+        'SERVICE_ID', 'SERVICE_NAME', 'SERVICE_DETAIL',
+        'PHYSICAL_ADDRESS', 'LATITUDE', 'LONGITUDE', 'PROVIDER_WEBSITE_1',
+        'PUBLISHED_CONTACT_EMAIL_1', 'PUBLISHED_PHONE_1', 'PROVIDER_CONTACT_AVAILABILITY',
+    ]
+    # columns that describe the service rather than its provider
+    service_columns = ['SERVICE_ID', 'SERVICE_NAME', 'SERVICE_DETAIL']
 
-    def build_query(self, category_id):
+    def __init__(self, resource):
+        super().__init__(resource)
+        self.filters = {category_id: CompiledFilter(expr) for category_id, expr in CKAN_FILTERS.items()}
 
-        filter_expr = CKAN_FILTERS[category_id]
+    def build_query(self, category_id, filter_expr=None, extra_columns=()):
+
+        filter_expr = filter_expr or CKAN_FILTERS[category_id]
 
         # Using SELECT DISTINCT (and not trying to return category data) means that
         # duplicate entries (across returned values) will be dropped.
         sql_template = """
-            SELECT DISTINCT "FSD_ID", "PROVIDER_NAME", "ORGANISATION_PURPOSE",
-                   "SERVICE_ID", "SERVICE_NAME", "SERVICE_DETAIL",
-                   "PHYSICAL_ADDRESS", "LATITUDE", "LONGITUDE", "PROVIDER_WEBSITE_1",
-                   "PUBLISHED_CONTACT_EMAIL_1", "PUBLISHED_PHONE_1", "PROVIDER_CONTACT_AVAILABILITY"
+            SELECT DISTINCT {columns}
               FROM "{resource}"
              WHERE "LATITUDE" IS NOT NULL
                AND "LONGITUDE" IS NOT NULL
@@ -101,10 +177,84 @@ class FamilyServicesDataSource(CKANDataSource):
           ORDER BY "LONGITUDE", "FSD_ID"
         """
 
-        return sql_template.format(resource=self.resource, filter=filter_expr)
+        columns = ', '.join('"{}"'.format(c) for c in self.columns + list(extra_columns))
+        return sql_template.format(columns=columns, resource=self.resource, filter=filter_expr)
+
+    def build_all_query(self, category_ids):
+        """
+        Builds the SQL query for every service, with the columns the
+        categories' filters look at.
+        """
+
+        columns = set().union(*(self.filters[category_id].columns for category_id in category_ids))
+        return self.build_query(None, filter_expr='TRUE', extra_columns=sorted(columns - set(self.columns)))
+
+    def query_all_services(self, category_ids):
+        """
+        Fetches several categories with a single CKAN query.
+
+        The categories share the same resource and differ only by their
+        CKAN_FILTERS expression. Instead of a remote query each, the resource
+        is downloaded once with the columns the filters look at, and the
+        filters are evaluated locally.
+
+        :param category_ids: ids of the categories to fetch
+        :returns: dict of category id -> records, same as query_services would
+                  return for each
+        """
+
+        filters = [(category_id, self.filters[category_id]) for category_id in category_ids]
+        # rows are filtered as they're parsed, so only the records kept are held
+        rows = self.stream_query(self.build_all_query(category_ids))
+
+        results = {category_id: [] for category_id in category_ids}
+        seen = {category_id: set() for category_id in category_ids}
+        for row in rows:
+            record = None
+            for category_id, matches in filters:
+                if not matches(row):
+                    continue
+                if record is None:
+                    record = {c: row[c] for c in self.columns}
+                    key = tuple(record.values())
+                # a row per category the service is in, keep one like SELECT DISTINCT does
+                if key not in seen[category_id]:
+                    seen[category_id].add(key)
+                    results[category_id].append(record)
+
+        for category_id in category_ids:
+            log.info('%s: %d results', category_id, len(results[category_id]))
+        return results
+
+    def group_by_provider(self, records):
+        """
+        There can be multiple services for the same provider. Groups the
+        records, one per service, into a single object per provider with its
+        services in `services`.
+
+        :param records: records as returned by query_services
+        :returns: list of providers, ordered by FSD_ID, each with its services
+                  sorted by name
+        """
+
+        providers = []
+        sortkeyfn = itemgetter('FSD_ID')
+
+        for _, group in groupby(sorted(records, key=sortkeyfn), key=sortkeyfn):
+            group = list(group)
+            # use the first record for the provider fields
+            provider = {c: v for c, v in group[0].items() if c not in self.service_columns}
+            provider['services'] = [
+                {c: record[c] for c in self.service_columns}
+                for record in sorted(group, key=itemgetter('SERVICE_NAME'))
+            ]
+            providers.append(provider)
+
+        return providers
 
 
 class SchoolsDataSource(CKANDataSource):
+    id_column = 'School_Id'
 
     def build_query(self, category_id):
 
@@ -124,6 +274,7 @@ class SchoolsDataSource(CKANDataSource):
 
 
 class EarlyEducationDataSource(CKANDataSource):
+    id_column = 'ECE_Id'
 
     def build_query(self, category_id):
 
@@ -186,6 +337,14 @@ class ServiceLookupManager:
         ]
 
         self._service_categories = OrderedDict((c.identifier, c) for c in category_list)
+        self._family_services = fs_datasource
+        # category id -> (dataset version, records)
+        self._records = {}
+        self._refresh_locks = {c: threading.Lock() for c in self._service_categories}
+        # category id -> when its last background refresh was started
+        self._background_refreshes = {}
+        self._background_lock = threading.Lock()
+        self.snapshots = SnapshotStore(settings.SERVICE_SNAPSHOT_DIR)
 
     @property
     def service_categories(self):
@@ -197,31 +356,433 @@ class ServiceLookupManager:
 
     def get_for_category(self, category_id):
         """
-        Fetches all services for the given category.
-        Results are cached to provide some resiliency for unreliable data sources
+        Fetches all services for the given category from the local store.
+
+        :param category_id:
+        """
+
+        return self.get_versioned(category_id)[1]
+
+    def get_versioned(self, category_id):
+        """
+        Fetches all services for the given category from the local store,
+        along with the version of the data. Anything derived from the records
+        can be cached against the version.
+
+        The store is filled by the `refresh_service_data` command, so CKAN is
+        not on the request path. Only a category that has never been
+        refreshed is fetched from CKAN here, and data older than
+        SERVICE_DATA_MAX_AGE is refreshed in the background while the stale
+        copy is served.
+
+        Records are read from a snapshot file of the stored version, memory
+        mapped so that all workers share one copy. Rows read like the dicts,
+        and are shared between requests, so they are read only.
 
         :param category_id:
+        :returns: tuple of (version, records)
         """
 
         if category_id not in self._service_categories:
             raise ObjectDoesNotExist()
 
-        category = self._service_categories[category_id]
+        dataset = CategoryDataset.objects.filter(category=category_id).first()
+        if dataset is None:
+            # one caller fetches, any others wait for it and share the result
+            dataset = self.refresh_category_once(category_id)
+        elif self.is_stale(dataset):
+            # cron has fallen behind. Serve what we have and refresh in the background.
+            self.refresh_in_background(category_id)
+
+        version, records = self._records.get(category_id, (None, None))
+        if version != dataset.version:
+            version, records = self.load_records(dataset)
+            self._records[category_id] = (version, records)
+
+        return version, records
+
+    def load_records(self, dataset):
+        """
+        Loads a dataset's records from its snapshot, which is written from
+        the store first if no one has yet. If the snapshot can't be written,
+        the records are held in this process instead.
+
+        Reading from the store holds the dataset's lock, so a refresh can't
+        change the records part way through, or after their version was read.
+
+        :returns: tuple of (version, records), the records read only. The
+                  version is newer than the dataset's if it has been
+                  refreshed since it was read.
+        """
+
+        records = self.snapshots.load(dataset.category, dataset.version)
+        if records is not None:
+            return dataset.version, records
+
+        with transaction.atomic():
+            dataset = CategoryDataset.objects.select_for_update().get(pk=dataset.pk)
+            records = self.snapshots.load(dataset.category, dataset.version)
+            if records is None:
+                data = dataset.records.values_list('data', flat=True)
+                try:
+                    self.snapshots.write(dataset.category, dataset.version, data.iterator())
+                    records = self.snapshots.load(dataset.category, dataset.version)
+                except OSError as e:
+                    log.error('Failed to write snapshot of %s: %s', dataset.category, e)
+                if records is None:
+                    records = ColumnarRecords(data.iterator())
+        return dataset.version, records
+
+    def get_refreshed_at(self):
+        """
+        :returns: dict of category id -> when it was last refreshed from CKAN
+        """
+        return dict(CategoryDataset.objects.values_list('category', 'refreshed_at'))
+
+    def is_stale(self, dataset):
+        """
+        Whether the dataset is due a refresh: it's older than
+        SERVICE_DATA_MAX_AGE, and isn't waiting to retry after CKAN failed.
+        """
+        now = timezone.now()
+        if dataset.retry_at is not None and dataset.retry_at > now:
+            return False
+        return dataset.refreshed_at < now - settings.SERVICE_DATA_MAX_AGE
+
+    @contextmanager
+    def refresh_lock(self, category_ids, wait=True):
+        """
+        Locks categories against being refreshed by anyone else: a lock per
+        category within the process, and a database advisory lock across
+        processes. Every refresh goes through it, whether from a request,
+        cron or warm_caches. Locks are always taken in the same order, so
+        refreshes of overlapping sets of categories can't deadlock.
+
+        :param wait: wait for the locks. If False, give up straight away when
+                     any of them is held.
+        :returns: context manager giving whether the locks were acquired
+        """
+        with ExitStack() as stack:
+            for category_id in sorted(category_ids):
+                lock = self._refresh_locks[category_id]
+                if not lock.acquire(blocking=wait):
+                    yield False
+                    return
+                stack.callback(lock.release)
+                if not stack.enter_context(advisory_lock('services_near_me:{}'.format(category_id), wait=wait)):
+                    yield False
+                    return
+            yield True
+
+    def refresh_category_once(self, category_id, wait=True):
+        """
+        Refreshes the category, unless another thread or process already is.
+
+        Concurrent callers are coalesced into a single CKAN fetch by the
+        refresh lock. Whoever gets the lock after someone else has refreshed
+        uses their result instead of fetching again.
+
+        :param wait: wait for an in-flight refresh to finish. If False,
+                     return None straight away when one is in flight.
+        :returns: the CategoryDataset for the category
+        """
+        with self.refresh_lock([category_id], wait=wait) as acquired:
+            if not acquired:
+                return None
+            dataset = CategoryDataset.objects.filter(category=category_id).first()
+            if dataset is not None and not self.is_stale(dataset):
+                return dataset
+            return self.refresh_category(category_id)
+
+    def refresh_in_background(self, category_id):
+        """
+        Refreshes the category in a background thread, unless a refresh of it
+        is already in flight in this process, or one was started less than
+        SERVICE_REFRESH_RETRY_INTERVAL ago, e.g. while another process holds
+        the lock or CKAN is down.
+
+        Under uWSGI the thread only runs if the `enable-threads` option is set.
+        """
+        def refresh():
+            try:
+                self.refresh_category_once(category_id, wait=False)
+            except Exception:
+                log.exception('Background refresh of %s failed', category_id)
+            finally:
+                connection.close()
+
+        now = time.monotonic()
+        with self._background_lock:
+            if self._refresh_locks[category_id].locked():
+                return
+            started = self._background_refreshes.get(category_id)
+            if started is not None and now - started < settings.SERVICE_REFRESH_RETRY_INTERVAL.total_seconds():
+                return
+            self._background_refreshes[category_id] = now
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def refresh_category(self, category_id):
+        """
+        Fetches the category from CKAN and updates its records in the local store.
+        Nothing is downloaded if the CKAN resource hasn't changed since the
+        last refresh, and only records that have changed are rewritten.
+
+        :param category_id:
+        :returns: the CategoryDataset for the category
+        """
+
+        data_source = self._service_categories[category_id].data_source
+        return self._refresh(data_source, [category_id],
+                             lambda: {category_id: self.fetch_for_category(category_id)},
+                             data_source.build_query(category_id))[category_id]
+
+    def refresh_categories(self, category_ids=None):
+        """
+        Refreshes several categories. Family services categories are fetched
+        from CKAN together, in one pass.
+
+        :param category_ids: categories to refresh, all of them by default
+        :returns: tuple of (dict of category id -> CategoryDataset,
+                  dict of category id -> exception for those that failed)
+        """
+
+        category_ids = list(category_ids or self.service_category_names)
+        family_ids = [c for c in category_ids if self.is_family_services(c)]
+        started = timezone.now()
+        datasets = {}
+        errors = {}
+
+        if family_ids:
+            try:
+                # the filters are applied here rather than in the query
+                parts = [self._family_services.build_all_query(family_ids)]
+                parts.extend(CKAN_FILTERS[category_id] for category_id in family_ids)
+                query = '\n'.join(parts)
+                datasets.update(self._refresh_once(family_ids, started, lambda: self._refresh(
+                    self._family_services, family_ids, lambda: self.fetch_family_services(family_ids), query)))
+            except CKANException as e:
+                errors.update((category_id, e) for category_id in family_ids)
+
+        for category_id in category_ids:
+            if category_id in family_ids:
+                continue
+            try:
+                datasets.update(self._refresh_once([category_id], started, lambda: {
+                    category_id: self.refresh_category(category_id)}))
+            except CKANException as e:
+                errors[category_id] = e
+
+        return datasets, errors
+
+    def _refresh_once(self, category_ids, since, refresh):
+        """
+        Runs a refresh holding the categories' refresh lock, waiting for any
+        in-flight refresh of them first. If that refreshed them all since
+        `since`, its result is used instead.
+
+        :param refresh: function refreshing the categories, returning a dict
+                        of category id -> CategoryDataset
+        :returns: dict of category id -> CategoryDataset
+        """
+        with self.refresh_lock(category_ids):
+            datasets = {d.category: d for d in CategoryDataset.objects.filter(
+                category__in=category_ids, refreshed_at__gte=since)}
+            if len(datasets) == len(category_ids):
+                log.info('%s refreshed by someone else, not fetching', ', '.join(category_ids))
+                return datasets
+            return refresh()
+
+    def is_family_services(self, category_id):
+        return self._service_categories[category_id].type is CategoryType.FAMILY_SERVICES
+
+    def _refresh(self, data_source, category_ids, fetch, query):
+        """
+        Refreshes categories from one data source, unless its resource and
+        the query are unchanged since they were last fetched.
+
+        :param fetch: function fetching the categories from CKAN, returning
+                      a dict of category id -> records
+        :param query: the SQL query fetch runs, and anything else deciding
+                      which records it returns
+        :returns: dict of category id -> CategoryDataset
+        """
 
         try:
-            results = category.data_source.query_services(category_id)
+            source_version = '{}/{}'.format(
+                data_source.resource_version(), hashlib.sha1(query.encode('utf-8')).hexdigest()[:16])
+        except CKANException:
+            # can't tell, so fetch it
+            source_version = ''
+
+        datasets = {d.category: d for d in CategoryDataset.objects.filter(category__in=category_ids)}
+        if source_version and len(datasets) == len(category_ids) and all(
+                d.source_version == source_version for d in datasets.values()):
+            log.info('%s unchanged (%s), not fetching', ', '.join(category_ids), source_version)
+            return self._mark_refreshed(datasets)
 
+        try:
+            results = fetch()
         except CKANException as e:
-            # failed to fetch from CKAN. Attempt to use cached results instead
-            cached_results = cache.get(category_id)
-            if cached_results:
-                log.warn('Failed to fetch results from CKAN. Returning cached results')
-                return cached_results
-            else:
-                # let view handle the exeption
-                raise e
-
-        # cache good results indefinitely
-        cache.set(category_id, results, None)
+            return self._fall_back(category_ids, datasets, e)
 
-        return results
+        return {
+            category_id: self._store_records(category_id, records, source_version)
+            for category_id, records in results.items()
+        }
+
+    def _fall_back(self, category_ids, datasets, error):
+        """
+        data.govt.nz don't provide any guarantees around availability.
+        When CKAN is unavailable, keeps serving the last records fetched: those
+        in the store, or the latest snapshot of any category the store
+        doesn't have, e.g. for a new database.
+
+        :param datasets: dict of category id -> CategoryDataset in the store
+        :returns: dict of category id -> CategoryDataset
+        :raises: the error, if there's nothing to fall back to
+        """
+
+        snapshots = {c: self.snapshots.latest(c) for c in category_ids if c not in datasets}
+        if not all(records is not None for _, records in snapshots.values()):
+            raise error
+
+        log.warn('Failed to fetch results from CKAN. Serving the last records fetched')
+        for category_id, (version, records) in snapshots.items():
+            # fetched when the snapshot was written
+            refreshed_at = datetime.fromtimestamp(
+                os.path.getmtime(self.snapshots.path(category_id, version)), timezone.utc)
+            datasets[category_id] = self._save_records(
+                category_id, [dict(record) for record in records], refreshed_at=refreshed_at)
+
+        # refreshed_at is left alone, as nothing was fetched. Wait a while
+        # before trying again, rather than on every request while CKAN is down.
+        retry_at = timezone.now() + settings.SERVICE_REFRESH_RETRY_INTERVAL
+        for dataset in datasets.values():
+            dataset.retry_at = retry_at
+            dataset.save()
+        return datasets
+
+    def _mark_refreshed(self, datasets):
+        now = timezone.now()
+        for dataset in datasets.values():
+            dataset.refreshed_at = now
+            dataset.retry_at = None
+            dataset.save()
+        return datasets
+
+    def _store_records(self, category_id, records, source_version=''):
+        data_source = self._service_categories[category_id].data_source
+        id_column = data_source.id_column
+
+        # can't be ordered, paged through or updated by id, so aren't served
+        missing_id = sum(1 for record in records if record.get(id_column) is None)
+        if missing_id:
+            log.warning('Skipping %d %s records without %s', missing_id, category_id, id_column)
+            records = [record for record in records if record.get(id_column) is not None]
+
+        if self.is_family_services(category_id):
+            # stored the way the API serves them, so requests don't have to group
+            records = data_source.group_by_provider(records)
+        else:
+            # in id order, which the API's cursor pagination relies on
+            records = sorted(records, key=itemgetter(id_column))
+
+        return self._save_records(category_id, records, source_version)
+
+    def _save_records(self, category_id, records, source_version='', refreshed_at=None):
+        data_source = self._service_categories[category_id].data_source
+        version = records_version(records)
+        now = refreshed_at or timezone.now()
+
+        with transaction.atomic():
+            dataset, created = CategoryDataset.objects.select_for_update().get_or_create(
+                category=category_id,
+                defaults={'version': version, 'refreshed_at': now},
+            )
+            if created or dataset.version != version:
+                added, changed, removed = update_records(dataset, records, data_source.id_column)
+                log.info('Updated %s: %d records added, %d changed, %d removed',
+                         category_id, added, changed, removed)
+
+            dataset.version = version
+            dataset.source_version = source_version
+            dataset.record_count = len(records)
+            dataset.refreshed_at = now
+            dataset.retry_at = None
+            dataset.save()
+
+        # ready for the workers, and to fall back to if CKAN goes down
+        try:
+            self.snapshots.write(category_id, version, records)
+        except OSError as e:
+            log.error('Failed to write snapshot of %s: %s', category_id, e)
+
+        return dataset
+
+    def fetch_family_services(self, category_ids):
+        """
+        Fetches several family services categories from CKAN in one query.
+
+        :param category_ids: family services categories to fetch
+        :returns: dict of category id -> records
+        """
+
+        return self._family_services.query_all_services(category_ids)
+
+    def fetch_for_category(self, category_id):
+        """
+        Fetches all services for the given category from CKAN.
+
+        :param category_id:
+        """
+
+        if category_id not in self._service_categories:
+            raise ObjectDoesNotExist()
+
+        return self._service_categories[category_id].data_source.query_services(category_id)
+
+
+def update_records(dataset, records, id_column):
+    """
+    Replaces a dataset's records, only writing the ones that have changed.
+    Records are matched up by their id column.
+
+    :param records: the new records
+    :returns: tuple of the number of records (added, changed, removed)
+    """
+
+    existing = {key: (pk, data) for pk, key, data in dataset.records.values_list('id', 'key', 'data')}
+    new = OrderedDict((record.get(id_column), record) for record in records)
+
+    if len(new) != len(records) or not all(type(key) is int for key in new) or None in existing:
+        # can't tell records apart, so rewrite them all
+        dataset.records.all().delete()
+        ServiceRecord.objects.bulk_create(
+            [ServiceRecord(dataset=dataset, data=record) for record in records], batch_size=1000)
+        return len(records), 0, len(existing)
+
+    removed = [pk for key, (pk, _) in existing.items() if key not in new]
+    changed = [
+        ServiceRecord(id=pk, dataset=dataset, key=key, data=new[key])
+        for key, (pk, data) in existing.items() if key in new and new[key] != data
+    ]
+    added = [ServiceRecord(dataset=dataset, key=key, data=record) for key, record in new.items() if key not in existing]
+
+    ServiceRecord.objects.filter(id__in=removed).delete()
+    for record in changed:
+        record.save(update_fields=['data'])
+    ServiceRecord.objects.bulk_create(added, batch_size=1000)
+
+    return len(added), len(changed), len(removed)
+
+
+def records_version(records):
+    """
+    Checksum of a list of CKAN records, changes whenever any record does.
+    Records are hashed one at a time, so the whole list is never held as text.
+    """
+    checksum = hashlib.sha1()
+    for record in records:
+        checksum.update(json.dumps(record, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        checksum.update(b'\n')
+    return checksum.hexdigest()
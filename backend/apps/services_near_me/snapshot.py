@@ -0,0 +1,316 @@
+"""
+On-disk snapshots of a category's records, memory mapped by every worker.
+
+A snapshot holds the same columns as ColumnarRecords, but in a file: each
+column is a fixed width array, numbers stored as they are and text as
+indexes into a string table of UTF-8 bytes. Workers map the file read only
+rather than reading it, so the records are loaded instantly, and held once
+in the page cache however many workers there are.
+
+Layout, in native byte order, each section starting on an 8 byte boundary:
+
+    magic, header length    8 bytes, unsigned 64 bit int
+    header                  JSON: record count, the string table and the
+                            columns, with the offset of each array
+    string offsets          unsigned 32 bit ints, one more than the strings
+    string data             the strings' UTF-8 bytes, one after another
+    per column:
+        values              64 bit ints or floats, or 32 bit string indexes
+        mask                optional, a byte per record: 0 for a value,
+                            1 for None, 2 for a key the record didn't have
+"""
+from array import array
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+
+from .columnar import MISSING, ColumnarRecords, collect_columns, is_float_text
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SVCSNAP1'
+PREFIX = struct.Struct('=8sQ')
+
+PRESENT, NULL, ABSENT = 0, 1, 2
+
+# kind -> array typecode of its values
+TYPECODES = {
+    'int': 'q',
+    'float': 'd',
+    'floattext': 'd',
+    'str': 'I',
+    'json': 'I',
+}
+
+
+class StringTable:
+    """Strings stored as UTF-8 bytes, decoded on access"""
+    __slots__ = ('offsets', 'data')
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __getitem__(self, i):
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+
+class SnapshotColumn:
+    __slots__ = ('values', 'mask', 'strings')
+
+    def __init__(self, values, mask, strings):
+        self.values = values
+        self.mask = mask
+        self.strings = strings
+
+    def __getitem__(self, i):
+        if self.mask is not None and self.mask[i]:
+            return None if self.mask[i] == NULL else MISSING
+        return self.value(i)
+
+    def value(self, i):
+        return self.values[i]
+
+
+class FloatTextColumn(SnapshotColumn):
+    """Decimal numbers CKAN returns as text, see columnar.FloatTextColumn"""
+    __slots__ = ()
+
+    def value(self, i):
+        return repr(self.values[i])
+
+
+class StrColumn(SnapshotColumn):
+    __slots__ = ()
+
+    def value(self, i):
+        return self.strings[self.values[i]]
+
+
+class JSONColumn(SnapshotColumn):
+    """
+    Any other values, e.g. the services of a provider, as JSON text. They
+    are decoded afresh on each access, so can't be changed in the snapshot.
+    """
+    __slots__ = ()
+
+    def value(self, i):
+        return json.loads(self.strings[self.values[i]])
+
+
+COLUMN_TYPES = {
+    'int': SnapshotColumn,
+    'float': SnapshotColumn,
+    'floattext': FloatTextColumn,
+    'str': StrColumn,
+    'json': JSONColumn,
+}
+
+
+def column_kind(values):
+    present = [v for v in values if v is not None and v is not MISSING]
+    if present:
+        if all(type(v) is int and -2 ** 63 <= v < 2 ** 63 for v in present):
+            return 'int'
+        if all(type(v) is float for v in present):
+            return 'float'
+        if all(type(v) is str for v in present):
+            return 'floattext' if all(is_float_text(v) for v in present) else 'str'
+    return 'json'
+
+
+def write_snapshot(path, records):
+    """
+    Writes records to a snapshot file. The file is replaced atomically, so
+    workers never see part of one.
+
+    :param path: file to write
+    :param records: iterable of record dicts
+    """
+    count, values = collect_columns(records)
+
+    strings = {}
+
+    def string_index(text):
+        return strings.setdefault(text, len(strings))
+
+    columns = []
+    for key, column in values.items():
+        kind = column_kind(column)
+        mask = array('B', (ABSENT if v is MISSING else NULL if v is None else PRESENT for v in column))
+        if kind == 'floattext':
+            convert = float
+        elif kind == 'str':
+            convert = string_index
+        elif kind == 'json':
+            def convert(value):
+                return string_index(json.dumps(value, separators=(',', ':')))
+        else:
+            def convert(value):
+                return value
+        data = array(TYPECODES[kind], (0 if m else convert(v) for v, m in zip(column, mask)))
+        columns.append((key, kind, data, mask if any(mask) else None))
+
+    encoded = [text.encode('utf-8') for text in strings]
+    offsets = array('I', [0])
+    for text in encoded:
+        offsets.append(offsets[-1] + len(text))
+    sections = [offsets, b''.join(encoded)]
+
+    header = {
+        'byteorder': sys.byteorder,
+        'count': count,
+        'strings': [len(strings), None, None],
+        'columns': [],
+    }
+    for key, kind, data, mask in columns:
+        header['columns'].append([key, kind, None, None])
+        sections.append(data)
+        if mask is not None:
+            sections.append(mask)
+
+    # section offsets depend on the header's length, which depends on the
+    # offsets: size the header with room for them, then fill them in
+    def layout(header_length):
+        position = align(PREFIX.size + header_length)
+        placed = []
+        for section in sections:
+            placed.append(position)
+            position = align(position + len(memoryview(section).cast('B')))
+        return placed
+
+    header_length = len(json.dumps(header)) + 24 * len(sections)
+    placed = iter(layout(header_length))
+    header['strings'][1:] = [next(placed), next(placed)]
+    for entry, (_, _, _, mask) in zip(header['columns'], columns):
+        entry[2] = next(placed)
+        entry[3] = next(placed) if mask is not None else None
+    encoded_header = json.dumps(header).encode('utf-8').ljust(header_length)
+
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(PREFIX.pack(MAGIC, header_length))
+            f.write(encoded_header)
+            for section in sections:
+                f.write(b'\0' * (align(f.tell()) - f.tell()))
+                f.write(memoryview(section).cast('B'))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def align(position):
+    return (position + 7) & ~7
+
+
+class SnapshotRecords(ColumnarRecords):
+    """
+    A category's records, read from a memory mapped snapshot file. Reads
+    like ColumnarRecords, except that nested values aren't shared between
+    rows.
+
+    :param path: the snapshot file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        magic, header_length = PREFIX.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('{} is not a snapshot'.format(path))
+        header = json.loads(str(buffer[PREFIX.size:PREFIX.size + header_length], 'utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('{} was written on a machine with a different byte order'.format(path))
+
+        count = header['count']
+        string_count, offsets_at, data_at = header['strings']
+        offsets = buffer[offsets_at:offsets_at + 4 * (string_count + 1)].cast('I')
+        strings = StringTable(offsets, buffer[data_at:data_at + offsets[string_count]])
+
+        self._length = count
+        self._columns = {}
+        for key, kind, values_at, mask_at in header['columns']:
+            typecode = TYPECODES[kind]
+            size = array(typecode).itemsize
+            values = buffer[values_at:values_at + size * count].cast(typecode)
+            mask = None if mask_at is None else buffer[mask_at:mask_at + count]
+            self._columns[sys.intern(key)] = COLUMN_TYPES[kind](values, mask, strings)
+
+
+class SnapshotStore:
+    """
+    A directory of snapshots, one per category and version of its records.
+
+    :param directory: where the snapshots are kept, created when first written
+    """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+
+    def path(self, category_id, version):
+        return os.path.join(self.directory, '{}-{}.snap'.format(category_id, version))
+
+    def load(self, category_id, version):
+        """
+        :returns: SnapshotRecords of that version of the category's records,
+                  or None if there's no snapshot of it
+        """
+        path = self.path(category_id, version)
+        if not os.path.exists(path):
+            return None
+        try:
+            return SnapshotRecords(path)
+        except (OSError, ValueError) as e:
+            log.warning('Failed to load snapshot %s: %s', path, e)
+            return None
+
+    def latest(self, category_id):
+        """
+        :returns: tuple of (version, SnapshotRecords) of the last snapshot
+                  written for the category, or (None, None) if there isn't one
+        """
+        versions = self.versions(category_id)
+        if not versions:
+            return None, None
+        version = max(versions, key=lambda v: os.path.getmtime(self.path(category_id, v)))
+        return version, self.load(category_id, version)
+
+    def versions(self, category_id):
+        pattern = re.compile(r'{}-(\w+)\.snap'.format(re.escape(category_id)))
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [m.group(1) for m in map(pattern.fullmatch, names) if m]
+
+    def write(self, category_id, version, records):
+        """
+        Writes a snapshot of a version of the category's records, unless
+        there already is one, and removes the snapshots of other versions.
+        Workers that have those mapped keep reading them until they move on.
+
+        :param records: iterable of record dicts
+        """
+        path = self.path(category_id, version)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            write_snapshot(path, records)
+            log.info('Wrote snapshot %s', path)
+
+        for other in self.versions(category_id):
+            if other != version:
+                try:
+                    os.unlink(self.path(category_id, other))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,203 @@
+from array import array
+from collections import defaultdict
+from math import asin, cos, floor, radians, sin, sqrt
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.195
+
+
+def haversine_km(lat, lng, lats, lngs, cos_lats, indices):
+    """
+    Great circle distance in km from one point to many.
+
+    `lats` and `lngs` are arrays of coordinates in radians, `cos_lats` the
+    precomputed cosine of each latitude, so only the varying part of the
+    formula is evaluated per point.
+
+    :returns: list of distances, in the order of `indices`
+    """
+    lat = radians(lat)
+    lng = radians(lng)
+    cos_lat = cos(lat)
+    diameter = 2 * EARTH_RADIUS_KM
+    distances = []
+    append = distances.append
+    for i in indices:
+        a = (sin((lats[i] - lat) / 2) ** 2
+             + cos_lat * cos_lats[i] * sin((lngs[i] - lng) / 2) ** 2)
+        append(diameter * asin(sqrt(min(a, 1.0))))
+    return distances
+
+
+class GridIndex:
+    """
+    In-memory spatial index over service records.
+
+    Records are bucketed into a grid of `cell_size` degree cells, so radius and
+    bounding box queries only look at records in the cells they overlap.
+    Records without usable coordinates are left out of the index.
+    """
+
+    def __init__(self, items, latitude_field, longitude_field, cell_size=0.1):
+        self.cell_size = cell_size
+        self.items = []
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.cells = defaultdict(list)
+
+        for item in items:
+            try:
+                lat = float(item[latitude_field])
+                lng = float(item[longitude_field])
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.cells[self._cell(lat, lng)].append(len(self.items))
+            self.items.append(item)
+            self.latitudes.append(lat)
+            self.longitudes.append(lng)
+
+        self._rad_lats = array('d', map(radians, self.latitudes))
+        self._rad_lngs = array('d', map(radians, self.longitudes))
+        self._cos_lats = array('d', map(cos, self._rad_lats))
+        # min and max latitude and longitude of the populated cells
+        self._extent = tuple(f(c[axis] for c in self.cells) for axis in (0, 1) for f in (min, max)) if self.cells else None
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cell(self, lat, lng):
+        return floor(lat / self.cell_size), floor(lng / self.cell_size)
+
+    def _candidates(self, min_lat, min_lng, max_lat, max_lng):
+        lat_start, lng_start = self._cell(min_lat, min_lng)
+        lat_end, lng_end = self._cell(max_lat, max_lng)
+        n_cells = (lat_end - lat_start + 1) * (lng_end - lng_start + 1)
+
+        if n_cells > len(self.cells):
+            # box is bigger than the populated part of the grid
+            cells = (
+                indices for (lat_cell, lng_cell), indices in self.cells.items()
+                if lat_start <= lat_cell <= lat_end and lng_start <= lng_cell <= lng_end
+            )
+        else:
+            cells = (
+                self.cells.get((lat_cell, lng_cell), ())
+                for lat_cell in range(lat_start, lat_end + 1)
+                for lng_cell in range(lng_start, lng_end + 1)
+            )
+        return [i for indices in cells for i in indices]
+
+    def distances(self, lat, lng, indices):
+        return haversine_km(lat, lng, self._rad_lats, self._rad_lngs, self._cos_lats, indices)
+
+    def query(self, lat=None, lng=None, radius_km=None, bbox=None, limit=None, include=None):
+        """
+        Find records near a point and/or inside a bounding box.
+
+        :param lat, lng: point to measure distance from
+        :param radius_km: only include records within this distance of the point
+        :param bbox: (min_lng, min_lat, max_lng, max_lat), only include records inside
+        :param limit: maximum number of records to return
+        :param include: function of a record, only include records it returns True for
+        :returns: list of (distance_km, record) tuples, nearest first. Distance is
+                  measured from the point, or from the centre of bbox if no point
+                  was given.
+        """
+        if lat is None and bbox is not None:
+            lat = (bbox[1] + bbox[3]) / 2
+            lng = (bbox[0] + bbox[2]) / 2
+        elif bbox is None and radius_km is None and limit is not None:
+            return self.nearest(lat, lng, limit, include)
+
+        if bbox is not None:
+            min_lng, min_lat, max_lng, max_lat = bbox
+            candidates = [
+                i for i in self._candidates(min_lat, min_lng, max_lat, max_lng)
+                if min_lat <= self.latitudes[i] <= max_lat
+                and min_lng <= self.longitudes[i] <= max_lng
+            ]
+        elif radius_km is not None:
+            lat_span = radius_km / KM_PER_DEGREE
+            lng_span = radius_km / (KM_PER_DEGREE * max(cos(radians(lat)), 0.01))
+            candidates = self._candidates(lat - lat_span, lng - lng_span, lat + lat_span, lng + lng_span)
+        else:
+            candidates = range(len(self.items))
+
+        if include is not None:
+            candidates = [i for i in candidates if include(self.items[i])]
+
+        results = zip(self.distances(lat, lng, candidates), candidates)
+        if radius_km is not None:
+            results = (r for r in results if r[0] <= radius_km)
+        results = sorted(results)
+        if limit is not None:
+            results = results[:limit]
+        return [(distance, self.items[i]) for distance, i in results]
+
+    def nearest(self, lat, lng, limit, include=None):
+        """
+        Find the records nearest to a point, without measuring the distance
+        to all of them.
+
+        Searches the cells in square rings around the point's cell, one ring
+        further out at a time, and stops once the records found are nearer
+        than anything outside the rings searched could be.
+
+        :param lat, lng: point to measure distance from
+        :param limit: number of records to return
+        :param include: function of a record, only include records it returns True for
+        :returns: list of (distance_km, record) tuples, nearest first, the
+                  same as query(lat, lng, limit=limit) would return
+        """
+        if not self.cells or limit <= 0:
+            return []
+
+        lat_cell, lng_cell = self._cell(lat, lng)
+        min_lat_cell, max_lat_cell, min_lng_cell, max_lng_cell = self._extent
+        last_ring = max(abs(lat_cell - min_lat_cell), abs(lat_cell - max_lat_cell),
+                        abs(lng_cell - min_lng_cell), abs(lng_cell - max_lng_cell))
+
+        results = []
+        for ring in range(last_ring + 1):
+            if (2 * ring + 1) ** 2 > 4 * len(self.cells):
+                # the rings are mostly empty cells by now, quicker to look at everything
+                return self.query(lat, lng, include=include)[:limit]
+
+            candidates = [i for cell in self._ring(lat_cell, lng_cell, ring) for i in self.cells.get(cell, ())]
+            if include is not None:
+                candidates = [i for i in candidates if include(self.items[i])]
+            results.extend(zip(self.distances(lat, lng, candidates), candidates))
+
+            if len(results) >= limit:
+                results = sorted(results)[:limit]
+                if results[-1][0] < self._clearance_km(lat, ring):
+                    break
+
+        return [(distance, self.items[i]) for distance, i in sorted(results)[:limit]]
+
+    def _ring(self, lat_cell, lng_cell, ring):
+        """
+        The cells `ring` cells away from a cell, in a square around it
+        """
+        if ring == 0:
+            return [(lat_cell, lng_cell)]
+        cells = []
+        for lng_offset in range(-ring, ring + 1):
+            cells.append((lat_cell - ring, lng_cell + lng_offset))
+            cells.append((lat_cell + ring, lng_cell + lng_offset))
+        for lat_offset in range(-ring + 1, ring):
+            cells.append((lat_cell + lat_offset, lng_cell - ring))
+            cells.append((lat_cell + lat_offset, lng_cell + ring))
+        return cells
+
+    def _clearance_km(self, lat, ring):
+        """
+        Least distance from a point to any record outside the rings of cells
+        searched around it. Such a record is at least `ring` cells away in
+        latitude or longitude, and degrees of longitude are shortest at the
+        latitude furthest from the equator it could be at.
+        """
+        degrees = ring * self.cell_size
+        furthest_lat = min(abs(lat) + (ring + 1) * self.cell_size, 90)
+        # a little under, since the distances are along great circles
+        return 0.99 * degrees * KM_PER_DEGREE * cos(radians(furthest_lat))
@@ -0,0 +1,606 @@
+from datetime import timedelta
+import io
+import json
+import os
+import random
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+from requests import Response
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from apps.services_near_me import jsonstream, serializers, views
+from apps.services_near_me.columnar import ColumnarRecords, FloatTextColumn, ObjectColumn
+from apps.services_near_me.compiled import serialize_many
+from apps.services_near_me.exceptions import CKANException
+
+from apps.services_near_me.models import CategoryDataset
+from apps.services_near_me.search import InvertedIndex
+from apps.services_near_me.snapshot import SnapshotRecords, SnapshotStore
+from apps.services_near_me.services import (
+    FamilyServicesDataSource, SchoolsDataSource, ServiceLookupManager
+)
+from apps.services_near_me.spatial import GridIndex
+
+WELLINGTON = (-41.2865, 174.7762)
+LOWER_HUTT = (-41.2091, 174.9081)
+AUCKLAND = (-36.8485, 174.7633)
+
+
+def record(name, lat, lng):
+    # CKAN returns family services coordinates as text
+    return {'name': name, 'LATITUDE': str(lat), 'LONGITUDE': str(lng)}
+
+
+class GridIndexTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.index = GridIndex([
+            record('auckland', *AUCKLAND),
+            record('wellington', *WELLINGTON),
+            record('lower hutt', *LOWER_HUTT),
+            record('no location', None, None),
+        ], 'LATITUDE', 'LONGITUDE')
+
+    def names(self, results):
+        return [r['name'] for _, r in results]
+
+    def test_skips_records_without_location(self):
+        self.assertEqual(len(self.index), 3)
+
+    def test_radius(self):
+        results = self.index.query(*WELLINGTON, radius_km=20)
+        self.assertEqual(self.names(results), ['wellington', 'lower hutt'])
+        self.assertAlmostEqual(results[0][0], 0)
+        self.assertAlmostEqual(results[1][0], 14, places=0)
+
+    def test_nearest_with_limit(self):
+        results = self.index.query(*AUCKLAND, limit=2)
+        self.assertEqual(self.names(results), ['auckland', 'lower hutt'])
+
+    def test_bbox(self):
+        # around the Wellington region, ordered from the box centre
+        results = self.index.query(bbox=(174.5, -41.5, 175.5, -41.0))
+        self.assertEqual(self.names(results), ['lower hutt', 'wellington'])
+
+    def test_nearest_matches_full_scan(self):
+        rnd = random.Random(0)
+        records = [record(i, rnd.uniform(-46.5, -34.5), rnd.uniform(166.5, 178.5)) for i in range(500)]
+        records += [record(500 + i, rnd.gauss(WELLINGTON[0], 0.05), rnd.gauss(WELLINGTON[1], 0.05)) for i in range(200)]
+        index = GridIndex(records, 'LATITUDE', 'LONGITUDE')
+
+        for _ in range(50):
+            lat, lng = rnd.uniform(-48, -33), rnd.uniform(165, 180)
+            limit = rnd.choice([1, 5, 50])
+            everything = sorted(zip(index.distances(lat, lng, range(len(index))), range(len(index))))
+            expected = [index.items[i]['name'] for _, i in everything[:limit]]
+            self.assertEqual(self.names(index.nearest(lat, lng, limit)), expected)
+
+
+class InvertedIndexTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.index = InvertedIndex([
+            {'PROVIDER_NAME': 'Plunket Wellington', 'services': [{'SERVICE_NAME': 'Well Child'}]},
+            {'PROVIDER_NAME': 'Te Whānau Trust', 'services': [{'SERVICE_NAME': 'Te reo parenting'}]},
+            {'PROVIDER_NAME': 'Budget Advice', 'services': [{'SERVICE_NAME': 'Budgeting'}, {'SERVICE_NAME': None}]},
+            {'PROVIDER_NAME': 'Family Centre', 'services': [{'SERVICE_NAME': 'Plunket clinic'}]},
+        ], {'PROVIDER_NAME': 2, 'services.SERVICE_NAME': 1})
+
+    def names(self, query):
+        return [r['PROVIDER_NAME'] for r in self.index.search(query)]
+
+    def test_ranking(self):
+        # provider name matches rank above service name matches
+        self.assertEqual(self.names('plunket'), ['Plunket Wellington', 'Family Centre'])
+        self.assertEqual(len(self.index.search('plunket', limit=1)), 1)
+
+    def test_all_words_must_match(self):
+        self.assertEqual(self.names('te reo'), ['Te Whānau Trust'])
+        self.assertEqual(self.names('plunket reo'), [])
+
+    def test_prefix_and_diacritics(self):
+        self.assertEqual(self.names('budget'), ['Budget Advice'])
+        self.assertEqual(self.names('budg'), ['Budget Advice'])
+        self.assertEqual(self.names('whanau'), ['Te Whānau Trust'])
+
+
+class JSONStreamTestCase(SimpleTestCase):
+
+    def chunks(self, text, size):
+        return (text[i:i + size] for i in range(0, len(text), size))
+
+    def test_iter_items(self):
+        records = [
+            {'FSD_ID': 12345, 'NAME': 'Te Whānau Trust', 'LATITUDE': '-41.2865', 'SCORE': -1.5e-3},
+            {'FSD_ID': 2, 'NAME': 'Plunket, "Wellington" [central]', 'LATITUDE': None, 'TAGS': [1, {'a': []}]},
+        ]
+        text = json.dumps({
+            'help': 'https://catalogue.data.govt.nz/api/3/action/help_show?name=datastore_search_sql',
+            'success': True,
+            'result': {'fields': [{'id': 'FSD_ID', 'type': 'int4'}], 'records': records, 'sql': 'SELECT 1'},
+        }, indent=1)
+
+        # values split across chunks anywhere, including numbers
+        for size in (1, 2, 3, 7, 64, len(text)):
+            self.assertEqual(list(jsonstream.iter_items(self.chunks(text, size), ('result', 'records'))), records)
+
+        self.assertEqual(list(jsonstream.iter_items(['{"result": {"records": [ ]}}'], ('result', 'records'))), [])
+        self.assertEqual(list(jsonstream.iter_items(['[1', '2, 3', '4]'], ())), [12, 34])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_items(['{"result": {"fields": []}}'], ('result', 'records')))
+        with self.assertRaises(ValueError):
+            list(jsonstream.iter_items(['{"result": {"records": [{"a": 1}, {"a"'], ('result', 'records')))
+
+
+class FamilyServicesBulkTestCase(SimpleTestCase):
+
+    def service(self, fsd_id, level_2_category, detail):
+        row = dict.fromkeys(FamilyServicesDataSource.columns, '')
+        row.update(FSD_ID=fsd_id, SERVICE_DETAIL=detail, LEVEL_2_CATEGORY=level_2_category)
+        return row
+
+    def test_query_all_services(self):
+        data_source = FamilyServicesDataSource('resource')
+        rows = [
+            self.service(1, 'Well Child Health (Tamariki Ora)', 'Well child checks'),
+            # same service listed under two categories
+            self.service(2, 'Breast Feeding Support', 'Lactation consultant'),
+            self.service(2, 'Well Child Health (Tamariki Ora)', 'Lactation consultant'),
+            self.service(3, 'Budgeting', None),
+        ]
+        with mock.patch.object(data_source, 'stream_query', return_value=iter(rows)) as stream_query:
+            results = data_source.query_all_services(['well-child', 'breastfeeding'])
+
+        self.assertEqual(stream_query.call_count, 1)
+        self.assertIn('"LEVEL_2_CATEGORY"', stream_query.call_args[0][0])
+        self.assertEqual([r['FSD_ID'] for r in results['well-child']], [1, 2])
+        self.assertEqual([r['FSD_ID'] for r in results['breastfeeding']], [2])
+        self.assertNotIn('LEVEL_2_CATEGORY', results['breastfeeding'][0])
+
+    def test_group_by_provider(self):
+        data_source = FamilyServicesDataSource('resource')
+        records = [
+            dict(self.service(2, '', 'Budgeting help'), SERVICE_NAME='Budgeting'),
+            dict(self.service(1, '', 'Checks'), SERVICE_NAME='Well child'),
+            dict(self.service(1, '', 'Classes'), SERVICE_NAME='Antenatal'),
+        ]
+        providers = data_source.group_by_provider(records)
+
+        self.assertEqual([p['FSD_ID'] for p in providers], [1, 2])
+        self.assertEqual([s['SERVICE_NAME'] for s in providers[0]['services']], ['Antenatal', 'Well child'])
+        self.assertEqual(providers[0]['services'][0], {'SERVICE_ID': '', 'SERVICE_NAME': 'Antenatal', 'SERVICE_DETAIL': 'Classes'})
+        self.assertNotIn('SERVICE_NAME', providers[0])
+        # the fetched records are left alone
+        self.assertNotIn('services', records[1])
+
+    @mock.patch('apps.services_near_me.services.get_client')
+    def test_stream_query_error_closes_response(self, get_client):
+        r = Response()
+        r.status_code = 409
+        r.raw = io.BytesIO(b'{"error": {"message": "bad query"}}')
+        get_client.return_value.post.return_value = r
+
+        with mock.patch.object(r, 'close', wraps=r.close) as close:
+            with self.assertRaises(CKANException):
+                list(FamilyServicesDataSource('resource').stream_query('SELECT'))
+        close.assert_called_once_with()
+
+
+class ColumnarRecordsTestCase(SimpleTestCase):
+
+    def test_rows_match_records(self):
+        records = [
+            {'FSD_ID': 1, 'LATITUDE': '-41.2865', 'SCORE': 1.5, 'NAME': 'Plunket'},
+            {'FSD_ID': 2, 'LATITUDE': '-41.20', 'SCORE': None, 'NAME': None},
+            {'FSD_ID': 3, 'LATITUDE': None, 'SCORE': 2.0, 'NAME': 'Barnardos', 'EXTRA': 'x'},
+        ]
+        table = ColumnarRecords(iter(records))
+
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table), records)
+        self.assertEqual(table[-1], records[-1])
+        self.assertEqual(table[1:], records[1:])
+        self.assertNotIn('EXTRA', table[0])
+        with self.assertRaises(KeyError):
+            table[0]['EXTRA']
+        with self.assertRaises(IndexError):
+            table[3]
+
+    def test_nested_values_are_frozen(self):
+        table = ColumnarRecords([{'services': [{'id': 1}]}])
+        services = table[0]['services']
+        self.assertEqual(dict(services[0]), {'id': 1})
+        with self.assertRaises(TypeError):
+            services[0]['id'] = 2
+
+    def test_columns(self):
+        table = ColumnarRecords([
+            {'id': 1, 'lat': -41.2, 'lat_text': '-41.2865', 'text': '-41.20'},
+            {'id': 2, 'lat': None, 'lat_text': '174.7762', 'text': 'abc'},
+        ])
+        columns = table._columns
+        self.assertEqual(columns['id'].values.typecode, 'q')
+        self.assertEqual(columns['lat'].values.typecode, 'd')
+        self.assertIsInstance(columns['lat_text'], FloatTextColumn)
+        # wouldn't come back as the same text
+        self.assertIsInstance(columns['text'], ObjectColumn)
+
+
+class SnapshotTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = SnapshotStore(os.path.join(directory.name, 'snapshots'))
+
+    def test_rows_match_records(self):
+        records = [
+            {'FSD_ID': 1, 'LATITUDE': '-41.2865', 'SCORE': 1.5, 'NAME': 'Te Whānau Trust',
+             'services': [{'SERVICE_ID': 10, 'SERVICE_NAME': 'Parenting'}], 'FREE': True},
+            {'FSD_ID': 2, 'LATITUDE': '-41.20', 'SCORE': None, 'NAME': None, 'services': []},
+            {'FSD_ID': 3, 'LATITUDE': None, 'SCORE': 2.0, 'NAME': 'Barnardos', 'EXTRA': 'x', 'FREE': None},
+        ]
+        self.store.write('well-child', 'v1', iter(records))
+        table = self.store.load('well-child', 'v1')
+
+        self.assertEqual(len(table), 3)
+        self.assertEqual(list(table), records)
+        self.assertEqual(table[-1], records[-1])
+        self.assertNotIn('EXTRA', table[0])
+        self.assertIsNone(self.store.load('well-child', 'v2'))
+
+        self.store.write('well-child', 'v0', [])
+        self.assertEqual(len(self.store.load('well-child', 'v0')), 0)
+
+    def test_versions(self):
+        self.store.write('well-child', 'v1', [{'FSD_ID': 1}])
+        self.store.write('well-child-extra', 'v1', [{'FSD_ID': 2}])
+        self.store.write('well-child', 'v2', [{'FSD_ID': 3}])
+
+        # older versions are removed
+        self.assertEqual(self.store.versions('well-child'), ['v2'])
+        version, table = self.store.latest('well-child')
+        self.assertEqual((version, list(table)), ('v2', [{'FSD_ID': 3}]))
+        self.assertEqual(self.store.latest('breastfeeding'), (None, None))
+
+
+class CompiledSerializerTestCase(SimpleTestCase):
+
+    def assertSameOutput(self, serializer_class, items, **kwargs):
+        render = JSONRenderer().render
+        self.assertEqual(
+            render(serialize_many(serializer_class(**kwargs), items)),
+            render(serializer_class(items, many=True, **kwargs).data))
+
+    def test_providers(self):
+        provider = dict.fromkeys(FamilyServicesDataSource.columns, 'x')
+        provider.update(FSD_ID='1', LATITUDE='-41.2865', LONGITUDE=None, services=[
+            {'SERVICE_ID': 2, 'SERVICE_NAME': 'Well child', 'SERVICE_DETAIL': None},
+        ])
+        items = ColumnarRecords([provider, dict(provider, FSD_ID=2, services=[])])
+        self.assertSameOutput(serializers.ProviderSerializer, items)
+        self.assertSameOutput(serializers.ProviderSerializer, items, context={'fields': ['id', 'services']})
+
+    def test_categories(self):
+        categories = ServiceLookupManager().service_categories
+        self.assertSameOutput(serializers.CategorySerializer, categories, context={'refreshed_at': {}})
+
+    def test_missing_field(self):
+        # falls back to DRF, which explains what is missing
+        with self.assertRaisesRegex(KeyError, 'Org_Name'):
+            serialize_many(serializers.SchoolSerializer(), [{'School_Id': 1}])
+
+
+class ServiceListTestCase(SimpleTestCase):
+
+    def setUp(self):
+        school = dict.fromkeys(['Org_Type', 'Definition', 'Add1_Line1', 'Add1_Suburb', 'Add1_City',
+                                'URL', 'Email', 'Telephone', 'Total'])
+        self.schools = ColumnarRecords(
+            dict(school, School_Id=i, Org_Name='School {}'.format(i), Latitude=-41.2, Longitude=174.7)
+            for i in range(1, 6)
+        )
+        patcher = mock.patch.object(views.service_manager, 'get_versioned', return_value=('v1', self.schools))
+        self.get_versioned = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, url, expected=200):
+        request = APIRequestFactory().get(url, HTTP_ACCEPT='application/json')
+        r = views.PrimarySchoolList.as_view()(request)
+        r.render()
+        self.assertEqual(r.status_code, expected)
+        return json.loads(r.content.decode('utf-8'))
+
+    def test_fields(self):
+        results = self.get('/?fields=id,name')
+        self.assertEqual(results[0], {'id': 1, 'name': 'School 1'})
+        self.get('/?fields=id,nope', expected=400)
+
+    def test_cursor_pagination(self):
+        page = self.get('/?page_size=2&fields=id')
+        self.assertEqual(page['results'], [{'id': 1}, {'id': 2}])
+
+        ids = []
+        while page['next']:
+            page = self.get(page['next'])
+            ids += [r['id'] for r in page['results']]
+        self.assertEqual(ids, [3, 4, 5])
+
+        self.get('/?cursor=nonsense', expected=404)
+        self.get('/?page_size=2&lat=-41&lng=174', expected=400)
+
+    def test_search(self):
+        self.assertEqual(self.get('/?q=school+3&fields=id'), [{'id': 3}])
+        self.assertEqual(len(self.get('/?q=school&limit=2')), 2)
+        # combined with a location, nearest first
+        self.assertEqual(self.get('/?q=school&lat=-41.2&lng=174.7&limit=1&fields=id'), [{'id': 1}])
+        self.get('/?q=+', expected=400)
+
+    def test_new_version(self):
+        request = APIRequestFactory().get('/', HTTP_ACCEPT='application/json')
+        r = views.PrimarySchoolList.as_view()(request)
+        etag = r['ETag']
+
+        # a refresh changes the body along with the ETag
+        self.get_versioned.return_value = ('v2', ColumnarRecords(list(self.schools)[:2]))
+        request = APIRequestFactory().get('/', HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+        r = views.PrimarySchoolList.as_view()(request)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], etag)
+        self.assertEqual(len(json.loads(r.content.decode('utf-8'))), 2)
+
+    def test_data_read_once(self):
+        self.get('/?q=school&lat=-41.2&lng=174.7&limit=1')
+        self.assertEqual(self.get_versioned.call_count, 1)
+
+
+class NearbyServicesTestCase(SimpleTestCase):
+
+    def setUp(self):
+        school = dict.fromkeys(['Org_Type', 'Definition', 'Add1_Line1', 'Add1_Suburb', 'Add1_City',
+                                'URL', 'Email', 'Telephone', 'Total'])
+        schools = ColumnarRecords([
+            dict(school, School_Id=1, Org_Name='Te Aro School', Latitude=WELLINGTON[0], Longitude=WELLINGTON[1]),
+            dict(school, School_Id=2, Org_Name='Hutt Central School', Latitude=LOWER_HUTT[0], Longitude=LOWER_HUTT[1]),
+            dict(school, School_Id=3, Org_Name='Ponsonby Primary', Latitude=AUCKLAND[0], Longitude=AUCKLAND[1]),
+        ])
+        provider = dict.fromkeys(['PROVIDER_NAME', 'ORGANISATION_PURPOSE', 'PHYSICAL_ADDRESS', 'PROVIDER_WEBSITE_1',
+                                  'PUBLISHED_CONTACT_EMAIL_1', 'PUBLISHED_PHONE_1', 'PROVIDER_CONTACT_AVAILABILITY'])
+        providers = ColumnarRecords([
+            dict(provider, FSD_ID=1, LATITUDE=str(AUCKLAND[0]), LONGITUDE=str(AUCKLAND[1]), services=[]),
+        ])
+
+        def get_versioned(category):
+            return ('nearby', schools) if category == 'primary-schools' else ('nearby', providers)
+
+        patcher = mock.patch.object(views.service_manager, 'get_versioned', side_effect=get_versioned)
+        self.get_versioned = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, url, expected=200):
+        request = APIRequestFactory().get(url, HTTP_ACCEPT='application/json')
+        r = views.NearbyServices.as_view()(request)
+        r.render()
+        self.assertEqual(r.status_code, expected)
+        return json.loads(r.content.decode('utf-8'))
+
+    def test_nearest_per_category(self):
+        results = self.get('/?lat=-41.29&lng=174.78&categories=primary-schools,well-child&limit=2')
+
+        self.assertEqual(list(results), ['primary-schools', 'well-child'])
+        self.assertEqual([s['name'] for s in results['primary-schools']], ['Te Aro School', 'Hutt Central School'])
+        self.assertLess(results['primary-schools'][0]['distance_km'], 1)
+        self.assertEqual([p['id'] for p in results['well-child']], [1])
+        self.assertEqual(self.get_versioned.call_count, 2)
+
+        results = self.get('/?lat=-41.29&lng=174.78&categories=well-child,primary-schools&radius_km=20')
+        self.assertEqual(results['well-child'], [])
+        self.assertEqual(len(results['primary-schools']), 2)
+
+    def test_all_categories(self):
+        results = self.get('/?lat=-41.29&lng=174.78')
+        self.assertEqual(list(results), list(views.service_manager.service_category_names))
+
+    def test_invalid(self):
+        self.get('/?categories=primary-schools', expected=400)
+        self.get('/?lat=-41.29&lng=174.78&categories=nope', expected=400)
+        self.get('/?lat=-41.29&lng=174.78&limit=1000', expected=400)
+
+
+class ServiceStoreTestCase(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with self.settings(SERVICE_SNAPSHOT_DIR=directory.name):
+            self.manager = ServiceLookupManager()
+        self.schools = [{'School_Id': 1, 'Org_Name': 'Te Aro School'}]
+
+        patcher = mock.patch.object(SchoolsDataSource, 'resource_version', return_value='2018-06-01T00:00:00/1')
+        self.resource_version = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_read_from_store(self, query_services):
+        query_services.return_value = self.schools
+
+        # never refreshed, so fetched on first use
+        self.assertEqual(list(self.manager.get_for_category('primary-schools')), self.schools)
+        self.assertEqual(query_services.call_count, 1)
+
+        # then served from the store, through its snapshot
+        manager = ServiceLookupManager()
+        manager.snapshots = self.manager.snapshots
+        records = manager.get_for_category('primary-schools')
+        self.assertIsInstance(records, SnapshotRecords)
+        self.assertEqual(list(records), self.schools)
+        self.assertEqual(query_services.call_count, 1)
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_load_records_refreshed(self, query_services):
+        query_services.return_value = self.schools
+        old = self.manager.refresh_category('primary-schools')
+
+        query_services.return_value = self.schools + [{'School_Id': 2, 'Org_Name': 'Clyde Quay School'}]
+        self.resource_version.return_value = '2018-07-01T00:00:00/2'
+        new = self.manager.refresh_category('primary-schools')
+        for version in self.manager.snapshots.versions('primary-schools'):
+            os.unlink(self.manager.snapshots.path('primary-schools', version))
+
+        # read before the refresh, so the snapshot is of the records there are now
+        version, records = self.manager.load_records(old)
+        self.assertEqual((version, len(records)), (new.version, 2))
+        self.assertEqual(self.manager.snapshots.versions('primary-schools'), [new.version])
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_refresh(self, query_services):
+        query_services.return_value = self.schools
+        version = self.manager.refresh_category('primary-schools').version
+
+        # unchanged data keeps its version
+        self.resource_version.return_value = '2018-06-02T00:00:00/1'
+        self.assertEqual(self.manager.refresh_category('primary-schools').version, version)
+
+        query_services.return_value = self.schools + [{'School_Id': 2, 'Org_Name': 'Clyde Quay School'}]
+        self.resource_version.return_value = '2018-07-01T00:00:00/2'
+        dataset = self.manager.refresh_category('primary-schools')
+        self.assertNotEqual(dataset.version, version)
+        self.assertEqual(dataset.record_count, 2)
+        self.assertEqual(CategoryDataset.objects.get().records.count(), 2)
+        self.assertEqual(len(self.manager.get_for_category('primary-schools')), 2)
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_refresh_skips_missing_ids(self, query_services):
+        query_services.return_value = [
+            {'School_Id': 2, 'Org_Name': 'Clyde Quay School'},
+            {'School_Id': None, 'Org_Name': 'Unnumbered School'},
+        ] + self.schools
+        with self.assertLogs('apps.services_near_me.services', 'WARNING'):
+            dataset = self.manager.refresh_category('primary-schools')
+        self.assertEqual(dataset.record_count, 2)
+        self.assertEqual([r['School_Id'] for r in self.manager.get_for_category('primary-schools')], [1, 2])
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_refresh_once(self, query_services):
+        query_services.return_value = self.schools
+        self.manager.refresh_category_once('primary-schools')
+        # already fresh, someone else refreshed it in the meantime
+        self.manager.refresh_category_once('primary-schools')
+        self.assertEqual(query_services.call_count, 1)
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_refresh_categories_once(self, query_services):
+        query_services.return_value = self.schools
+        self.manager.refresh_categories(['primary-schools'])
+        self.assertEqual(query_services.call_count, 1)
+
+        # refreshed by a request while cron waited for the lock
+        def refresh_while_waiting(*args, **kwargs):
+            self.manager.refresh_category('primary-schools')
+            return refresh_lock(*args, **kwargs)
+
+        refresh_lock = self.manager.refresh_lock
+        self.resource_version.side_effect = CKANException
+        with mock.patch.object(self.manager, 'refresh_lock', side_effect=refresh_while_waiting):
+            datasets, errors = self.manager.refresh_categories(['primary-schools'])
+        self.assertEqual((list(datasets), errors), (['primary-schools'], {}))
+        self.assertEqual(query_services.call_count, 2)
+
+    @mock.patch('apps.services_near_me.services.threading.Thread')
+    def test_refresh_in_background_once(self, Thread):
+        self.manager.refresh_in_background('primary-schools')
+        self.manager.refresh_in_background('primary-schools')
+        self.assertEqual(Thread.call_count, 1)
+
+        # already refreshing in this process
+        self.manager._background_refreshes.clear()
+        with self.manager._refresh_locks['primary-schools']:
+            self.manager.refresh_in_background('primary-schools')
+        self.assertEqual(Thread.call_count, 1)
+
+        self.manager.refresh_in_background('early-education')
+        self.assertEqual(Thread.call_count, 2)
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_resource_unchanged(self, query_services):
+        query_services.return_value = self.schools
+        refreshed_at = self.manager.refresh_category('primary-schools').refreshed_at
+
+        # not downloaded again, but counts as refreshed
+        dataset = self.manager.refresh_category('primary-schools')
+        self.assertEqual(query_services.call_count, 1)
+        self.assertGreater(dataset.refreshed_at, refreshed_at)
+
+        # a changed query is fetched, even though the resource isn't
+        with mock.patch.object(SchoolsDataSource, 'build_query', return_value='SELECT 1'):
+            self.manager.refresh_category('primary-schools')
+        self.assertEqual(query_services.call_count, 2)
+
+        # can't check the resource, so it's downloaded
+        self.resource_version.side_effect = CKANException
+        self.manager.refresh_category('primary-schools')
+        self.assertEqual(query_services.call_count, 3)
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_update_changed_records(self, query_services):
+        query_services.return_value = [
+            {'School_Id': 3, 'Org_Name': 'Clyde Quay School'},
+            {'School_Id': 1, 'Org_Name': 'Te Aro School'},
+            {'School_Id': 2, 'Org_Name': 'Mount Cook School'},
+        ]
+        dataset = self.manager.refresh_category('primary-schools')
+        ids = dict(dataset.records.values_list('key', 'id'))
+
+        query_services.return_value = [
+            {'School_Id': 4, 'Org_Name': 'Thorndon School'},
+            {'School_Id': 1, 'Org_Name': 'Te Aro School'},
+            {'School_Id': 3, 'Org_Name': 'Clyde Quay School (Wellington)'},
+        ]
+        self.resource_version.return_value = '2018-07-01T00:00:00/3'
+        dataset = self.manager.refresh_category('primary-schools')
+
+        # rows are updated in place, and still read in id order
+        records = list(dataset.records.values_list('key', 'id'))
+        self.assertEqual([key for key, _ in records], [1, 3, 4])
+        self.assertEqual(records[0][1], ids[1])
+        self.assertEqual(records[1][1], ids[3])
+        self.assertEqual(
+            [r['Org_Name'] for r in self.manager.get_for_category('primary-schools')],
+            ['Te Aro School', 'Clyde Quay School (Wellington)', 'Thorndon School'])
+
+    @mock.patch.object(SchoolsDataSource, 'query_services')
+    def test_fall_back_to_snapshot(self, query_services):
+        query_services.return_value = self.schools
+        self.manager.refresh_category('primary-schools')
+
+        query_services.side_effect = CKANException
+        self.resource_version.side_effect = CKANException
+        # the store has the records. They weren't refreshed, but aren't
+        # fetched again until it's time to retry.
+        refreshed_at = CategoryDataset.objects.get().refreshed_at
+        dataset = self.manager.refresh_category('primary-schools')
+        self.assertEqual(dataset.record_count, 1)
+        self.assertEqual(dataset.refreshed_at, refreshed_at)
+        self.assertGreater(dataset.retry_at, timezone.now())
+        with self.settings(SERVICE_DATA_MAX_AGE=timedelta(0)):
+            self.assertFalse(self.manager.is_stale(dataset))
+            dataset.retry_at = timezone.now()
+            self.assertTrue(self.manager.is_stale(dataset))
+
+        # a new database doesn't, but the snapshot does
+        CategoryDataset.objects.all().delete()
+        self.assertEqual(self.manager.refresh_category('primary-schools').record_count, 1)
+        self.assertEqual(list(self.manager.get_for_category('primary-schools')), self.schools)
+
+        # nothing to fall back to
+        for version in self.manager.snapshots.versions('primary-schools'):
+            os.unlink(self.manager.snapshots.path('primary-schools', version))
+        CategoryDataset.objects.all().delete()
+        with self.assertRaises(CKANException):
+            self.manager.refresh_category('primary-schools')
@@ -10,6 +10,8 @@ urlpatterns = [
         views.PrimarySchoolList.as_view(), name='primary_schools'),
     url(r'^service-locations/early-education/$',
         views.EarlyEducationSchoolList.as_view(), name='early_education'),
+    url(r'^service-locations/nearby/$',
+        views.NearbyServices.as_view(), name='nearby'),
     url(r'^service-locations/(?P<category>[a-z-]+)/$',
         views.FamilyServiceList.as_view(), name='service_locations'),
 ]
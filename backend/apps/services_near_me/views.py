@@ -1,17 +1,22 @@
-from operator import itemgetter
-from itertools import groupby
+from collections import OrderedDict
 import logging
 
+from django.core.exceptions import ImproperlyConfigured
 from rest_framework import generics
 from rest_framework.permissions import AllowAny
-from rest_framework.exceptions import NotFound
-
-from django.conf import settings
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from apps.base.compression import negotiate_encoding, PrecompressedBody
+from apps.base.views import ConditionalGetMixin
+from .compiled import serialize_many
+from .pagination import IdCursorPagination
+from .search import InvertedIndex, tokenize
 from .services import ServiceLookupManager
+from .spatial import GridIndex
 from . import serializers
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
 
 log = logging.getLogger(__name__)
 
@@ -19,76 +24,369 @@ log = logging.getLogger(__name__)
 service_manager = ServiceLookupManager()
 
 
-@method_decorator(cache_page(settings.CACHE_TTL_SECONDS), 'list')
-class CategoryList(generics.ListAPIView):
+class VersionedCache:
+    """
+    Per process cache of values derived from a category's records.
+
+    Each category holds one value, built for a particular dataset version,
+    and is rebuilt when the version changes.
     """
-    All the categories that the /service-locations/<category-id>/ resource can be queried by
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, category, version, build):
+        cached = self._values.get(category)
+        if cached is None or cached[0] != version:
+            cached = self._values[category] = (version, build())
+        return cached[1]
+
+
+_ids = VersionedCache()
+_search_indexes = VersionedCache()
+_spatial_indexes = VersionedCache()
+_response_bodies = VersionedCache()
+
+
+class LocationFilterMixin:
+    """
+    Optional geographic filtering for the service lists.
+
+    Query parameters:
+
+    - lat, lng: return results sorted by distance from this point
+    - radius_km: only results within this distance of lat, lng
+    - bbox: min_lng,min_lat,max_lng,max_lat, only results inside this box
+    - limit: maximum number of results
+
+    Without any of these the full list is returned, as before.
+    """
+    latitude_field = None
+    longitude_field = None
+
+    def get_spatial_index(self):
+        version, items = self.get_data()
+        return _spatial_indexes.get(
+            self.get_category(), version,
+            lambda: GridIndex(items, self.latitude_field, self.longitude_field))
+
+    def filter_by_location(self, location, include=None):
+        return [item for _, item in self.get_spatial_index().query(include=include, **location)]
+
+    def get_location_params(self):
+        params = self.request.query_params
+        location = {}
+
+        try:
+            if 'lat' in params or 'lng' in params:
+                location['lat'] = float(params['lat'])
+                location['lng'] = float(params['lng'])
+            if 'radius_km' in params:
+                location['radius_km'] = float(params['radius_km'])
+            if 'bbox' in params:
+                bbox = tuple(float(v) for v in params['bbox'].split(','))
+                if len(bbox) != 4:
+                    raise ValueError
+                location['bbox'] = bbox
+            if 'limit' in params:
+                location['limit'] = int(params['limit'])
+        except (KeyError, ValueError):
+            raise ValidationError(
+                'lat and lng must be given together, bbox must be min_lng,min_lat,max_lng,max_lat')
+
+        if 'radius_km' in location and 'lat' not in location:
+            raise ValidationError('radius_km requires lat and lng')
+        if 'limit' in location and 'lat' not in location and 'bbox' not in location and 'q' not in params:
+            raise ValidationError('limit requires lat and lng, bbox or q')
+        if location.get('radius_km', 0) < 0 or location.get('limit', 0) < 0:
+            raise ValidationError('radius_km and limit must not be negative')
+        return location
+
+
+class SearchMixin:
+    """
+    Keyword search for the service lists.
+
+    Query parameters:
+
+    - q: words to search for in the `search_fields`. Results are ranked best
+      first, or by distance when combined with lat and lng or bbox.
+    """
+    # dict of dotted field path -> weight
+    search_fields = None
+
+    def get_search_index(self):
+        version, items = self.get_data()
+        return _search_indexes.get(
+            self.get_category(), version,
+            lambda: InvertedIndex(items, self.search_fields))
+
+    def get_search_query(self):
+        query = self.request.query_params.get('q')
+        if query is not None and not tokenize(query):
+            raise ValidationError('q must contain at least one word')
+        return query
+
+
+class CategoryList(ConditionalGetMixin, generics.ListAPIView):
+    """
+    All the categories that the /service-locations/<category-id>/ resource can be queried by,
+    with when each was last refreshed from CKAN
     """
     serializer_class = serializers.CategorySerializer
     permission_classes = (AllowAny,)
 
+    def get_refreshed_at(self):
+        if not hasattr(self, '_refreshed_at'):
+            self._refreshed_at = service_manager.get_refreshed_at()
+        return self._refreshed_at
+
+    def get_etag_parts(self):
+        return sorted(self.get_refreshed_at().items())
+
     def get_queryset(self):
         return service_manager.service_categories
 
+    def list(self, request, *args, **kwargs):
+        return Response(serialize_many(self.get_serializer(), self.get_queryset()))
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['refreshed_at'] = self.get_refreshed_at()
+        return context
+
 
-@method_decorator(cache_page(settings.CACHE_TTL_SECONDS), 'list')
-class FamilyServiceList(generics.ListAPIView):
+class ServiceList(ConditionalGetMixin, SearchMixin, LocationFilterMixin, generics.ListAPIView):
     """
-    Fetches all services of the category provided in the URL param
+    Base for the lists of services in a category.
+
+    The full list is the same for everyone until the data is refreshed, so
+    its JSON body is rendered and compressed once per dataset version and
+    served as is. Responses carry an ETag made from the dataset version, so
+    clients that already have it get a 304. Items are serialized with the
+    compiled fast path, which gives the same output as the serializers.
+
+    Query parameters, besides the search and location ones:
+
+    - fields: comma separated names of the fields to include, e.g. for a
+      lightweight set of map markers
+    - page_size, cursor: page through the list in id order, following the
+      `next` link of each page
     """
-    serializer_class = serializers.ProviderSerializer
     permission_classes = (AllowAny,)
+    pagination_class = IdCursorPagination
+    category = None
+    id_field = None
+
+    def get_category(self):
+        if self.category is None:
+            raise ImproperlyConfigured('{} must set category or override get_category()'.format(type(self).__name__))
+        return self.category
+
+    def get_data(self):
+        """
+        Read once per request, so the ETag, indexes and body all come from
+        the same dataset version even if a refresh lands mid-request.
+
+        :returns: tuple of (dataset version, items)
+        """
+        if not hasattr(self, '_data'):
+            self._data = service_manager.get_versioned(self.get_category())
+        return self._data
+
+    def get_ids(self):
+        version, items = self.get_data()
+        return _ids.get(self.get_category(), version, lambda: [item[self.id_field] for item in items])
+
+    def get_fields_param(self):
+        if 'fields' not in self.request.query_params:
+            return None
+        fields = [f for f in self.request.query_params['fields'].split(',') if f]
+        available = self.get_serializer_class()._declared_fields
+        unknown = [f for f in fields if f not in available]
+        if unknown or not fields:
+            raise ValidationError('fields must be a comma separated list of: {}'.format(', '.join(available)))
+        return fields
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_fields_param()
+        return context
+
+    def get_etag_parts(self):
+        return self.get_category(), self.get_data()[0], negotiate_encoding(self.request)
 
     def get_queryset(self):
-        category = self.kwargs['category']
+        location = self.get_location_params()
+        query = self.get_search_query()
 
-        if category not in service_manager.service_category_names:
-            raise NotFound("Unknown category '{}'".format(category))
+        if (location or query) and self.paginator.is_requested(self.request):
+            raise ValidationError('page_size and cursor cannot be used with q or location filters, use limit')
+
+        if query:
+            index = self.get_search_index()
+            if set(location) - {'limit'}:
+                matched = {item[self.id_field] for item in index.search(query)}
+                return self.filter_by_location(location, include=lambda item: item[self.id_field] in matched)
+            return index.search(query, limit=location.get('limit'))
+
+        if location:
+            return self.filter_by_location(location)
+        return self.get_data()[1]
+
+    def is_full_list(self, request):
+        """
+        Whether the request is for the full list as JSON, which is the same
+        for everyone and served pre-rendered
+        """
+        if self.get_location_params() or self.paginator.is_requested(request):
+            return False
+        if 'q' in request.query_params or 'fields' in request.query_params:
+            return False
+        return request.accepted_renderer.format == 'json'
 
-        records = service_manager.get_for_category(category)
+    def list(self, request, *args, **kwargs):
+        if not self.is_full_list(request):
+            queryset = self.get_queryset()
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(serialize_many(self.get_serializer(), page))
+            return Response(serialize_many(self.get_serializer(), queryset))
 
-        # There can be multiple services for the same provider. Group these together into
-        # a single provider object.
+        version, items = self.get_data()
+        body = _response_bodies.get(
+            self.get_category(), version,
+            lambda: PrecompressedBody(JSONRenderer().render(serialize_many(self.get_serializer(), items))))
+        return body.response(request)
 
-        providers = []
-        sortkeyfn = itemgetter('FSD_ID')
-        records = sorted(records, key=sortkeyfn)
 
-        for _, group in groupby(records, key=sortkeyfn):
-            provider_group = list(group)  # all the records for the same provider
-            # use the first record to produce the provider object
-            provider = provider_group[0]
+class FamilyServiceList(ServiceList):
+    """
+    Fetches all services of the category provided in the URL param,
+    grouped by provider when they were stored
+    """
+    serializer_class = serializers.ProviderSerializer
+    id_field = 'FSD_ID'
+    search_fields = {'PROVIDER_NAME': 3, 'services.SERVICE_NAME': 2, 'services.SERVICE_DETAIL': 1}
+    latitude_field = 'LATITUDE'
+    longitude_field = 'LONGITUDE'
 
-            # sort services by name
-            service_sortkeyfn = itemgetter('SERVICE_NAME')
+    def get_category(self):
+        category = self.kwargs['category']
 
-            # put the whole record in 'services' for now. Let the serializer restrict
-            # to just the service fields
-            provider['services'] = sorted(provider_group, key=service_sortkeyfn)
-            providers.append(provider)
+        if category not in service_manager.service_category_names:
+            raise NotFound("Unknown category '{}'".format(category))
 
-        return providers
+        return category
 
 
-@method_decorator(cache_page(settings.CACHE_TTL_SECONDS), 'list')
-class PrimarySchoolList(generics.ListAPIView):
+class PrimarySchoolList(ServiceList):
     """
     Fetches all primary school services
     """
+    category = 'primary-schools'
     serializer_class = serializers.SchoolSerializer
-    permission_classes = (AllowAny,)
+    id_field = 'School_Id'
+    search_fields = {'Org_Name': 1}
+    latitude_field = 'Latitude'
+    longitude_field = 'Longitude'
 
-    def get_queryset(self):
-        return service_manager.get_for_category('primary-schools')
 
-
-@method_decorator(cache_page(settings.CACHE_TTL_SECONDS), 'list')
-class EarlyEducationSchoolList(generics.ListAPIView):
+class EarlyEducationSchoolList(ServiceList):
     """
     Fetches all early education services
     """
+    category = 'early-education'
     serializer_class = serializers.EarlyEducationSerializer
+    id_field = 'ECE_Id'
+    search_fields = {'Org_Name': 1}
+    latitude_field = 'Latitude'
+    longitude_field = 'Longitude'
+
+
+def get_list_view(category):
+    """
+    :returns: the view class listing the category's services
+    """
+    return {
+        'primary-schools': PrimarySchoolList,
+        'early-education': EarlyEducationSchoolList,
+    }.get(category, FamilyServiceList)
+
+
+class NearbyServices(ConditionalGetMixin, APIView):
+    """
+    The services nearest to a point in several categories at once, for a
+    "services near me" page, instead of fetching each category's full list.
+    Uses the same spatial indexes as the category lists.
+
+    Query parameters:
+
+    - lat, lng: the point, required
+    - categories: comma separated category ids, all of them by default
+    - limit: number of services per category, 5 by default
+    - radius_km: only services within this distance of the point
+
+    Returns an object of category id -> list of services, nearest first,
+    each as in its category's list plus its `distance_km`.
+    """
     permission_classes = (AllowAny,)
+    default_limit = 5
+    max_limit = 50
 
-    def get_queryset(self):
-        return service_manager.get_for_category('early-education')
+    def get_params(self):
+        params = self.request.query_params
+        try:
+            lat = float(params['lat'])
+            lng = float(params['lng'])
+            limit = int(params.get('limit', self.default_limit))
+            radius_km = float(params['radius_km']) if 'radius_km' in params else None
+        except (KeyError, ValueError):
+            raise ValidationError('lat and lng are required, limit and radius_km must be numbers')
+        if not 0 <= limit <= self.max_limit or (radius_km or 0) < 0:
+            raise ValidationError('limit must be 0 to {}, radius_km must not be negative'.format(self.max_limit))
+
+        categories = list(service_manager.service_category_names)
+        if 'categories' in params:
+            requested = [c for c in params['categories'].split(',') if c]
+            unknown = [c for c in requested if c not in categories]
+            if unknown:
+                raise ValidationError("Unknown categories: {}".format(', '.join(unknown)))
+            categories = list(OrderedDict.fromkeys(requested))
+
+        return lat, lng, limit, radius_km, categories
+
+    def get_data(self):
+        """
+        :returns: OrderedDict of category id -> (dataset version, items) of
+                  the categories requested
+        """
+        if not hasattr(self, '_data'):
+            categories = self.get_params()[-1]
+            self._data = OrderedDict((c, service_manager.get_versioned(c)) for c in categories)
+        return self._data
+
+    def get_etag_parts(self):
+        return [(category, version) for category, (version, _) in self.get_data().items()]
+
+    def get(self, request, *args, **kwargs):
+        lat, lng, limit, radius_km, _ = self.get_params()
+        context = {'request': request, 'format': self.format_kwarg, 'view': self}
+        results = OrderedDict()
+
+        for category, (version, items) in self.get_data().items():
+            view = get_list_view(category)
+            index = _spatial_indexes.get(
+                category, version,
+                lambda: GridIndex(items, view.latitude_field, view.longitude_field))
+
+            nearest = index.nearest(lat, lng, limit)
+            if radius_km is not None:
+                nearest = [(distance, item) for distance, item in nearest if distance <= radius_km]
+
+            services = serialize_many(view.serializer_class(context=context), [item for _, item in nearest])
+            for service, (distance, _) in zip(services, nearest):
+                service['distance_km'] = round(distance, 3)
+            results[category] = services
+
+        return Response(results)
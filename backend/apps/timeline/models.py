@@ -1,19 +1,26 @@
 from datetime import date, timedelta
+from functools import lru_cache
+from time import monotonic
 
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.template.loader import render_to_string
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
-from django.core.mail import get_connection
 
 from mistune import markdown
 from apps.base.models import TimeStampedModel, Choice
-from apps.base.mail import build_email_message
+from apps.base.mail import build_email_message, SMTPConnectionPool
 from apps.accounts.models import UserProxy
 import logging
 log = logging.getLogger(__name__)
 
 PREGNANCY_TOTAL_WEEKS = 40
+PHASE_INDEX_TTL_SECONDS = 60
+NOTIFICATION_CHUNK_SIZE = 100
+UNSUBSCRIBE_URL_PLACEHOLDER = 'UNSUBSCRIBE-URL-PLACEHOLDER-5c1f0e6d'
 
 
 class PregnancyHelper:
@@ -59,14 +66,74 @@ class PregnancyHelper:
     def get_phase_date_for_all(self):
         return {
             phase.id: self.get_phase_date(phase)
-            for phase in PhaseMetadata.objects.all()
+            for phase in PhaseMetadata.objects.get_phase_index().phases
         }
 
 
+class PhaseIndex:
+    """
+    Precomputed week number -> phase lookup table.
+
+    The phase table is tiny and only changes via admin, so it is loaded once
+    and resolved with a list lookup instead of a range query per call.
+    Where phases overlap, the one with the lowest id wins, same as
+    `.filter(...).first()` with the default ordering.
+    """
+
+    def __init__(self, phases):
+        self.phases = list(phases)
+        self.built_at = monotonic()
+        self.first_week = min((p.weeks_start for p in self.phases), default=0)
+        last_week = max((p.weeks_finish for p in self.phases), default=-1)
+        self.weeks = [None] * max(last_week - self.first_week + 1, 0)
+        for phase in self.phases:
+            for weekno in range(phase.weeks_start, phase.weeks_finish + 1):
+                i = weekno - self.first_week
+                if self.weeks[i] is None:
+                    self.weeks[i] = phase
+
+    @property
+    def expired(self):
+        return monotonic() - self.built_at > PHASE_INDEX_TTL_SECONDS
+
+    def get(self, weekno):
+        i = weekno - self.first_week
+        if 0 <= i < len(self.weeks):
+            return self.weeks[i]
+        return None
+
+
+# process-local, reset by the signal handlers below when a phase is saved or
+# deleted in this process. Other processes pick up changes once the TTL expires.
+_phase_index = None
+
+
+@lru_cache(maxsize=128)
+def render_markdown(content):
+    """
+    Render markdown to html, memoized on the content itself.
+
+    Editing a phase changes its content and so its cache key, there is
+    nothing to invalidate.
+    """
+    return mark_safe(markdown(content))
+
+
 class PhaseMetadataManager(models.Manager):
 
+    def get_phase_index(self):
+        global _phase_index
+        index = _phase_index
+        if index is None or index.expired:
+            index = _phase_index = PhaseIndex(self.get_queryset().order_by('id'))
+        return index
+
+    def clear_phase_index(self):
+        global _phase_index
+        _phase_index = None
+
     def get_phase_by_weekno(self, weekno):
-        return self.get_queryset().filter(weeks_start__lte=weekno, weeks_finish__gte=weekno).first()
+        return self.get_phase_index().get(weekno)
 
     def get_phase(self, due_date, ref_date=None):
         helper = PregnancyHelper(due_date)
@@ -100,7 +167,48 @@ class PhaseMetadata(TimeStampedModel):
 
     @property
     def markdown_content(self):
-        return mark_safe(markdown(self.content))
+        return render_markdown(self.content)
+
+
+@receiver(post_save, sender=PhaseMetadata)
+@receiver(post_delete, sender=PhaseMetadata)
+def clear_phase_index(sender, **kwargs):
+    PhaseMetadata.objects.clear_phase_index()
+
+
+@receiver(post_save, sender=PhaseMetadata)
+def render_phase_markdown(sender, instance, **kwargs):
+    # populate the cache now, rather than on the first email or page view
+    render_markdown(instance.content)
+
+
+# phase id -> ((modified_at, SITE_URL), template fragments)
+_phase_templates = {}
+
+
+def render_phase_template(phase):
+    """
+    Render the notification template for a phase with a placeholder for the
+    recipient's unsubscribe url, and return the fragments around it.
+
+    Results are cached per phase, and re-rendered when the phase is modified.
+    """
+    version = (phase.modified_at, settings.SITE_URL)
+    cached = _phase_templates.get(phase.id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    html = render_to_string(
+        'timeline/notification.html',
+        {
+            'notification': {'user': {'unsubscribe_url': UNSUBSCRIBE_URL_PLACEHOLDER}},
+            'phase': phase,
+            'SITE_URL': settings.SITE_URL,
+        }
+    )
+    fragments = html.split(UNSUBSCRIBE_URL_PLACEHOLDER)
+    _phase_templates[phase.id] = (version, fragments)
+    return fragments
 
 
 class MailStatus(Choice):
@@ -117,21 +225,68 @@ class NotificationManager(models.Manager):
     def pending(self):
         return self.get_queryset().filter(status=MailStatus.pending.name)
 
-    def send_all(self, notifications=None):
+    def send_all(self, notifications=None, chunk_size=NOTIFICATION_CHUNK_SIZE):
         """
-        Send emails for all pending notifications in batch.
+        Send emails for all pending notifications in chunks.
+
+        Establishing and closing an SMTP connection is an expensive process,
+        and one connection can only send one message at a time. Emails go out
+        through a SMTPConnectionPool, each of its connections kept open for
+        the whole run.
 
-        Establishing and closing an SMTP connection is an expensive process.
-        This function will send all emails with one connection.
+        Notifications are streamed from the database `chunk_size` at a time,
+        so memory use does not grow with the number of pending emails.
+        Each chunk is moved to `sending` before any email goes out, and every
+        message then gets its own `delivered` or `failed` status. If the
+        process dies halfway, finished chunks keep their status and the
+        interrupted one is left in `sending` rather than being resent.
 
-        The send_messages method will open a connection on the backend,
-        sends the list of messages, and then closes the connection again.
+        :returns: number of emails delivered
         """
-        notifications = notifications or self.pending()  # cache here for later use
-        messages = [n.build_email_message() for n in notifications]
-        connection = get_connection()
-        connection.send_messages(messages)
-        notifications.update(status=MailStatus.delivered.name)
+        if notifications is None:
+            notifications = self.pending()
+        notifications = notifications.select_related('phase', 'user').order_by('id')
+
+        delivered = 0
+        with SMTPConnectionPool() as pool:
+            chunk = []
+            for notification in notifications.iterator():
+                chunk.append(notification)
+                if len(chunk) >= chunk_size:
+                    delivered += self._send_chunk(chunk, pool)
+                    chunk = []
+            if chunk:
+                delivered += self._send_chunk(chunk, pool)
+        return delivered
+
+    def _send_chunk(self, notifications, pool):
+        ids = [n.id for n in notifications]
+        self.get_queryset().filter(id__in=ids).update(status=MailStatus.sending.name)
+
+        delivered_ids = []
+        failed_ids = []
+        messages = []
+        sendable = []
+        for notification in notifications:
+            try:
+                messages.append(notification.build_email_message())
+                sendable.append(notification)
+            except Exception:
+                log.exception('Failed to build email for notification %s', notification.id)
+                failed_ids.append(notification.id)
+
+        for notification, sent in zip(sendable, pool.send_messages(messages)):
+            if sent:
+                delivered_ids.append(notification.id)
+            else:
+                failed_ids.append(notification.id)
+
+        if delivered_ids:
+            self.get_queryset().filter(id__in=delivered_ids).update(status=MailStatus.delivered.name)
+        if failed_ids:
+            self.get_queryset().filter(id__in=failed_ids).update(status=MailStatus.failed.name)
+        log.info('Sent notification chunk: %d delivered, %d failed', len(delivered_ids), len(failed_ids))
+        return len(delivered_ids)
 
 
 class Notification(TimeStampedModel):
@@ -167,14 +322,13 @@ class Notification(TimeStampedModel):
         return self.helper.get_weekno(ref_date=self.created_at.date())
 
     def render_email_template(self):
-        return render_to_string(
-            'timeline/notification.html',
-            {
-                'notification': self,
-                'phase': self.phase,
-                'SITE_URL': settings.SITE_URL,
-            }
-        )
+        """
+        Everything in the email except the unsubscribe url is the same for
+        all recipients of a phase, so splice the url into the pre-rendered
+        phase template instead of rendering the whole template each time.
+        """
+        fragments = render_phase_template(self.phase)
+        return escape(self.user.unsubscribe_url).join(fragments)
 
     def build_email_message(self):
         """
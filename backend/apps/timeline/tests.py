@@ -1,8 +1,16 @@
 from datetime import date, timedelta
+import json
+from unittest import mock
+from django.conf import settings
+from django.core import mail
 from django.core.management import call_command
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase
+from apps.base.compression import PrecompressedBody
 from apps.base.tests import BaseTestCase
 from apps.accounts.models import UserProxy
 from apps.timeline import models as m
+from apps.timeline import views
 
 
 class PhaseMetadataTestCase(BaseTestCase):
@@ -28,6 +36,27 @@ class PhaseMetadataTestCase(BaseTestCase):
         self.get_json(self.api_phasemetadata, expected=200)
         self.post_json(self.api_phasemetadata, data=data, expected=403)
 
+    def test_conditional_get(self):
+        r = self.client.get(self.api_phasemetadata)
+        etag = r['ETag']
+
+        r = self.client.get(self.api_phasemetadata, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r['ETag'], etag)
+        self.assertEqual(r.content, b'')
+
+        # a changed phase is a new version
+        phase = m.PhaseMetadata.objects.get(id=6)
+        phase.weeks_finish = 70
+        phase.save()
+        r = self.client.get(self.api_phasemetadata, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r['ETag'], etag)
+
+        # each phase has its own ETag
+        r = self.client.get(self.api_phasemetadata + '6/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 200)
+
     def test_get_weeks(self):
         due_date = date(2016, 10, 28)
         helper = m.PregnancyHelper(due_date)
@@ -37,6 +66,22 @@ class PhaseMetadataTestCase(BaseTestCase):
         self.assertEqual(helper.get_weekno(ref_date=due_date + timedelta(days=1)), m.PREGNANCY_TOTAL_WEEKS)
         self.assertEqual(helper.get_weekno(ref_date=due_date + timedelta(days=7)), m.PREGNANCY_TOTAL_WEEKS + 1)
 
+    def test_phase_index(self):
+        manager = m.PhaseMetadata.objects
+        manager.get_phase_index()
+        with self.assertNumQueries(0):
+            self.assertEqual(manager.get_phase_by_weekno(0).id, 1)
+            self.assertEqual(manager.get_phase_by_weekno(15).id, 2)
+            self.assertEqual(manager.get_phase_by_weekno(65).id, 6)
+            self.assertIsNone(manager.get_phase_by_weekno(-1))
+            self.assertIsNone(manager.get_phase_by_weekno(66))
+
+        # saving a phase rebuilds the index
+        phase = manager.get(id=6)
+        phase.weeks_finish = 70
+        phase.save()
+        self.assertEqual(manager.get_phase_by_weekno(70).id, 6)
+
     def test_notifications(self):
         """
         Test most common case for notification.
@@ -91,3 +136,138 @@ class PhaseMetadataTestCase(BaseTestCase):
         self.assertEqual(user.notification_set.count(), 3)
         n = user.notification_set.get(phase_id=3)
         self.assertEqual(n.status, 'pending')
+
+    def test_bulk_notifications(self):
+        """
+        All subscribers get their notifications from a single bulk call,
+        and notifications for an outdated due date are replaced.
+        """
+        today = date.today()
+        due_date = today - timedelta(days=30) + timedelta(weeks=40)
+
+        self.admin.set_due_date(due_date)
+        self.test.set_due_date(due_date - timedelta(days=1))
+        UserProxy.objects.generate_notifications(ref_date=today)
+        self.assertEqual(m.Notification.objects.filter(phase_id=1).count(), 2)
+
+        # user changes due date within the same phase
+        self.test.set_due_date(due_date)
+        targets = UserProxy.objects.generate_notifications(ref_date=today)
+        self.assertEqual(set(targets), {self.admin.id, self.test.id})
+        self.assertEqual(self.test.notification_set.count(), 1)
+        self.assertEqual(self.test.notification_set.get().due_date, due_date)
+
+        # unsubscribed users are left out
+        self.admin.unsubscribe()
+        targets = UserProxy.objects.generate_notifications(ref_date=today)
+        self.assertEqual(set(targets), {self.test.id})
+
+    def test_bulk_notifications_skip_failures(self):
+        today = date.today()
+        due_date = today - timedelta(days=30) + timedelta(weeks=40)
+        self.admin.set_due_date(due_date)
+        self.test.set_due_date(due_date - timedelta(days=1))
+
+        # the admin's phase lookup fails, the other subscriber still gets theirs
+        get_weekno = m.PregnancyHelper.get_weekno
+
+        def fail_for_admin(helper, *args, **kwargs):
+            if helper.due_date == due_date:
+                raise ValueError('bad row')
+            return get_weekno(helper, *args, **kwargs)
+
+        with mock.patch.object(m.PregnancyHelper, 'get_weekno', autospec=True, side_effect=fail_for_admin):
+            targets = UserProxy.objects.generate_notifications(ref_date=today)
+        self.assertEqual(set(targets), {self.test.id})
+        self.assertTrue(self.test.notification_set.exists())
+        self.assertFalse(self.admin.notification_set.exists())
+
+    def test_send_all_chunks(self):
+        today = date.today()
+        due_date = today - timedelta(days=30) + timedelta(weeks=40)
+        self.admin.set_due_date(due_date)
+        self.test.set_due_date(due_date)
+        UserProxy.objects.generate_notifications(ref_date=today)
+
+        delivered = m.Notification.objects.send_all(chunk_size=1)
+        self.assertEqual(delivered, 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(m.Notification.objects.filter(status='delivered').count(), 2)
+
+        # nothing pending left, nothing sent again
+        self.assertEqual(m.Notification.objects.send_all(), 0)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_send_all_failed(self):
+        today = date.today()
+        self.test.set_due_date(today - timedelta(days=30) + timedelta(weeks=40))
+        UserProxy.objects.generate_notifications(ref_date=today)
+
+        with mock.patch.object(m.Notification, 'build_email_message', side_effect=ValueError):
+            delivered = m.Notification.objects.send_all()
+        self.assertEqual(delivered, 0)
+        self.assertEqual(self.test.notification_set.get().status, 'failed')
+
+    def test_render_email_template(self):
+        """Pre-rendered phase template gives the same result as a full render"""
+        today = date.today()
+        self.test.set_due_date(today - timedelta(days=30) + timedelta(weeks=40))
+        UserProxy.objects.generate_notifications(ref_date=today)
+        n = self.test.notification_set.get()
+
+        expected = render_to_string('timeline/notification.html', {
+            'notification': n,
+            'phase': n.phase,
+            'SITE_URL': settings.SITE_URL,
+        })
+        self.assertEqual(n.render_email_template(), expected)
+        # second render comes from the cache
+        self.assertEqual(n.render_email_template(), expected)
+
+    def test_render_markdown(self):
+        """Markdown is rendered once per content, and edits render the new content"""
+        phase = m.PhaseMetadata.objects.get(id=1)
+        phase.content = 'Week **one**'
+        phase.save()
+
+        hits = m.render_markdown.cache_info().hits
+        self.assertHTMLEqual(phase.markdown_content, '<p>Week <strong>one</strong></p>')
+        # prefilled by the post_save handler
+        self.assertEqual(m.render_markdown.cache_info().hits, hits + 1)
+        self.assertHTMLEqual(phase.markdown_content, '<p>Week <strong>one</strong></p>')
+        self.assertEqual(m.render_markdown.cache_info().hits, hits + 2)
+
+        phase.content = 'Week **two**'
+        phase.save()
+        phase = m.PhaseMetadata.objects.get(id=1)
+        self.assertHTMLEqual(phase.markdown_content, '<p>Week <strong>two</strong></p>')
+
+
+class TimelineContentTestCase(SimpleTestCase):
+
+    @mock.patch('apps.timeline.views.get_timeline_content')
+    def test_fetched_once(self, get_timeline_content):
+        content = {'phases': []}
+        get_timeline_content.return_value = ('v1', content, PrecompressedBody(json.dumps(content).encode('utf-8')))
+
+        r = self.client.get('/api/timeline/content/')
+        self.assertEqual(json.loads(r.content.decode('utf-8')), content)
+        self.assertEqual(get_timeline_content.call_count, 1)
+
+        r = self.client.get('/api/timeline/content/', HTTP_IF_NONE_MATCH=r['ETag'])
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(get_timeline_content.call_count, 2)
+
+    @mock.patch('apps.timeline.views.get_client')
+    def test_held_in_memory(self, get_client):
+        get_client.return_value.get.return_value = mock.Mock(content=b'{"phases": []}', json=lambda: {'phases': []})
+        views.timeline_cache.clear()
+        self.addCleanup(views.timeline_cache.clear)
+
+        # held in this process even when the shared cache doesn't keep anything
+        version = views.get_timeline_content()[0]
+        self.assertEqual(views.get_timeline_content()[0], version)
+        self.assertEqual(get_client.return_value.get.call_count, 1)
+
+        views.get_timeline_content(refresh=True)
+        self.assertEqual(get_client.return_value.get.call_count, 2)
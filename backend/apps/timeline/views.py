@@ -1,28 +1,79 @@
-import requests
+import hashlib
+import logging
 
 from rest_framework.viewsets import ReadOnlyModelViewSet
 from rest_framework.serializers import HyperlinkedModelSerializer
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.renderers import JSONRenderer
+from rest_framework.views import APIView
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.cache import cache_page
 from django.utils.decorators import method_decorator
 
+from apps.base.cache import TieredCache
+from apps.base.compression import negotiate_encoding, PrecompressedBody
 from apps.base.permissions import ReadOnly
+from apps.base.upstream import get_client
+from apps.base.views import ConditionalGetMixin
 from apps.timeline.models import PhaseMetadata, Notification
 
+log = logging.getLogger(__name__)
 
-@cache_page(settings.CACHE_TTL_SECONDS)
-@api_view()
-@permission_classes((AllowAny,))
-def timeline_content(request):
-    r = requests.get(settings.TIMELINE_URL, headers={'User-Agent': settings.TIMELINE_USER_AGENT})
-    return Response(r.json())
+TIMELINE_CONTENT_CACHE_KEY = 'timeline_content'
+
+# the content and its precompressed bodies are read on every timeline
+# request, so each worker holds them in memory rather than unpickling them
+# from the shared cache every time. After warm_caches fetches new content,
+# other workers pick it up within TIMELINE_CACHE_TIMEOUT.
+timeline_cache = TieredCache(cache, timeout=settings.TIMELINE_CACHE_TIMEOUT)
+
+
+def get_timeline_content(refresh=False):
+    """
+    The timeline content from govt.nz, cached for CACHE_TTL_SECONDS.
+
+    :param refresh: fetch it again even if it's cached
+
+    :returns: tuple of (version, content, body), where version is a hash of
+              the response taken once when it's fetched, and body the content
+              rendered to JSON and precompressed
+    """
+    cached = None if refresh else timeline_cache.get(TIMELINE_CONTENT_CACHE_KEY)
+    if cached is None:
+        r = get_client('govt.nz').get(settings.TIMELINE_URL, headers={'User-Agent': settings.TIMELINE_USER_AGENT})
+        content = r.json()
+        cached = (hashlib.sha1(r.content).hexdigest(), content, PrecompressedBody(JSONRenderer().render(content)))
+        timeline_cache.set(TIMELINE_CONTENT_CACHE_KEY, cached, settings.CACHE_TTL_SECONDS)
+        log.info('Fetched timeline content (cache %s)', timeline_cache.stats())
+    return cached
+
+
+class TimelineContent(ConditionalGetMixin, APIView):
+    permission_classes = (AllowAny,)
+
+    def get_timeline_content(self):
+        # once per request, so the ETag and the body are the same version
+        if not hasattr(self, '_timeline_content'):
+            self._timeline_content = get_timeline_content()
+        return self._timeline_content
+
+    def get_etag_parts(self):
+        return self.get_timeline_content()[0], negotiate_encoding(self.request)
+
+    def get(self, request):
+        version, content, body = self.get_timeline_content()
+        if request.accepted_renderer.format == 'json':
+            return body.response(request)
+        return Response(content)
+
+
+timeline_content = TimelineContent.as_view()
 
 
 # Serializers define the API representation.
@@ -33,11 +84,16 @@ class PhaseMetadataSerializer(HyperlinkedModelSerializer):
 
 
 @method_decorator(ensure_csrf_cookie, name='dispatch')
-class PhaseMetadataViewSet(ReadOnlyModelViewSet):
+class PhaseMetadataViewSet(ConditionalGetMixin, ReadOnlyModelViewSet):
     queryset = PhaseMetadata.objects.all()
     serializer_class = PhaseMetadataSerializer
     permission_classes = [ReadOnly]
 
+    def get_etag_parts(self):
+        # any change to the phases bumps the latest modified_at, deletes change the count
+        latest = PhaseMetadata.objects.aggregate(Max('modified_at'), Count('id'))
+        return latest['modified_at__max'], latest['id__count']
+
 
 def notification_detail(request, id):
     obj = get_object_or_404(Notification, id=id)
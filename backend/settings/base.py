@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     'apps.realme',
     'apps.timeline',
     'apps.request_cache',
+    'apps.services_near_me',
 
     # 3rd party apps
     'django_extensions',
@@ -128,6 +129,11 @@ DEFAULT_FROM_EMAIL = 'from-email'
 REPLY_TO_EMAIL = 'reply-to-email'
 BOUNCE_TO_EMAIL = 'return-path-email'
 
+# parallel SMTP connections used to send notifications
+EMAIL_POOL_SIZE = 4
+# messages per second, should match the SES sending quota. 0 to disable.
+EMAIL_MAX_SEND_RATE = 14
+
 # Smartstart relies on the PostgreSQL JSON field type, and no longer works with SQLite.
 DATABASES = {
     'default': {
@@ -165,13 +171,34 @@ BUNDLE_NAME = 'PRD'  # MTS, ITE-uat, ITE-testing, PRD
 # Default settings for apps/request_cache
 REQUEST_CACHE_TTL = timedelta(hours=24)
 CKAN_QUERY_URL = 'https://catalogue.data.govt.nz/api/action/datastore_search_sql'
+CKAN_RESOURCE_URL = 'https://catalogue.data.govt.nz/api/action/resource_show'
+CKAN_SEARCH_URL = 'https://catalogue.data.govt.nz/api/action/datastore_search'
 LBS_DATASET = '"35de6bf8-b254-4025-89f5-da9eb6adf9a0"'  # Must have "double quotes" around it.
 TIMELINE_URL = 'https://www.govt.nz/BoacAPI/v1/all'
 TIMELINE_USER_AGENT = requests.utils.default_user_agent()
+# seconds the timeline content is served from a worker's memory before the
+# shared cache is read again, for content fetched by other processes
+TIMELINE_CACHE_TIMEOUT = 5 * 60
 
 FAMILY_SERVICES_RESOURCE = '35de6bf8-b254-4025-89f5-da9eb6adf9a0'
 SCHOOLS_RESOURCE = 'bdfe0e4c-1554-4701-a8fe-ba1c8e0cc2ce'
 EARLY_EDUCATION_RESOURCE = '26f44973-b06d-479d-b697-8d7943c97c57'
+# service data older than this is refreshed in the background on next use,
+# in case the refresh_service_data cron job stops running
+SERVICE_DATA_MAX_AGE = timedelta(hours=24)
+# each process starts at most one background refresh of a category per
+# interval, and after CKAN fails it's not tried again for this long. The
+# background refreshes run in threads, so uWSGI needs `enable-threads = true`.
+SERVICE_REFRESH_RETRY_INTERVAL = timedelta(minutes=5)
+# snapshots of the service data, memory mapped by the workers, and served
+# if CKAN is down
+SERVICE_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+
+# upstream HTTP APIs (CKAN, govt.nz, RealMe): (connect, read) timeouts in
+# seconds, and how many times to retry failed requests, with backoff
+UPSTREAM_TIMEOUT = (5, 60)
+UPSTREAM_RETRIES = 2
+UPSTREAM_RETRY_BACKOFF = 0.5
 
 # ############ END OVERRIDE #############
 
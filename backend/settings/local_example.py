@@ -15,9 +15,6 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
     },
-    'db': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-    }
 }
 
 # Add valid PostgreSQL database details here. Smartstart relies on the